@@ -0,0 +1,63 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare random seeks and reads in a zip member opened with zipfile (the former
+# playback stream) and with the playback sources, for stored and deflated members.
+# Usage: python bench_playback_seek.py [size_in_MB] [nb_seeks]
+
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from playback_source import PlaybackSources
+
+
+def seek_and_read(stream, positions):
+    for position in positions:
+        stream.seek(position)
+        stream.read(4096)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    nb_seeks = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    # incompressible enough to look like mp3 data
+    data = os.urandom(size*1024**2//2) * 2
+    positions = [random.randrange(len(data)-4096) for _ in range(nb_seeks)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        zippath = os.path.join(directory, 'sounds.zip')
+        with zipfile.ZipFile(zippath, 'w') as zfile:
+            zfile.writestr('stored.mp3', data, compress_type=zipfile.ZIP_STORED)
+            zfile.writestr('deflated.mp3', data, compress_type=zipfile.ZIP_DEFLATED)
+        sources = PlaybackSources(cache_dir=directory)
+
+        print(f"{nb_seeks} seeks in a {size} MB member")
+        for member in ('stored.mp3', 'deflated.mp3'):
+            t0 = time.perf_counter()
+            with zipfile.ZipFile(zippath, 'r') as zfile, zfile.open(member) as stream:
+                seek_and_read(stream, positions)
+            legacy = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            with sources.open(zippath, member) as stream:
+                first = time.perf_counter() - t0
+                seek_and_read(stream, positions)
+            total = time.perf_counter() - t0
+            with sources.open(zippath, member) as stream:
+                stream.seek(positions[0])
+                assert stream.read(4096) == data[positions[0]:positions[0]+4096]
+
+            print(f"{member:14s} zipfile {legacy*1000:9.1f} ms   sources {total*1000:9.1f} ms (open {first*1000:.1f} ms)")
+        sources.close()
+
+
+if __name__ == '__main__':
+    main()
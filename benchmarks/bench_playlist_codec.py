@@ -0,0 +1,91 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the 
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare the struct-based playlist.bin codec with the former
+# field-by-field reader/writer.
+# Usage: python bench_playlist_codec.py [nb_items]
+
+import io
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from io_utils import read_merlin_playlist, write_merlin_playlist
+
+
+def legacy_read(stream):
+    items = []
+    while (b:=stream.read(2)):
+        item = dict()
+        item['id'] = int.from_bytes(b, byteorder='little')
+        for key, size in (('parent_id', 2), ('order', 2), ('nb_children', 2), ('fav_order', 2),
+                          ('type', 2), ('limit_time', 4), ('add_time', 4)):
+            b = stream.read(size)
+            if not b: raise Exception("wrong file format")
+            item[key] = int.from_bytes(b, byteorder='little')
+        for key, size in (('uuid', 64), ('title', 66)):
+            length = int.from_bytes(stream.read(1), byteorder='little')
+            item[key] = stream.read(length).decode('UTF-8')
+            stream.read(size-length)
+        items.append(item)
+    return items
+
+
+def legacy_write(stream, items):
+    for item in items:
+        for key, size in (('id', 2), ('parent_id', 2), ('order', 2), ('nb_children', 2), ('fav_order', 2),
+                          ('type', 2), ('limit_time', 4), ('add_time', 4)):
+            stream.write(item[key].to_bytes(size, byteorder='little'))
+        for key, size in (('uuid', 64), ('title', 66)):
+            b = item[key].encode('UTF-8')
+            stream.write(len(b).to_bytes(1, byteorder='little'))
+            stream.write(b)
+            stream.write(b'\x00'*(size-len(b)))
+
+
+def make_items(n):
+    items = [{'id': 1, 'parent_id': 0, 'order': 0, 'nb_children': n-1, 'fav_order': 0, 'type': 1,
+              'limit_time': 0, 'add_time': 0, 'uuid': '', 'title': 'Root'}]
+    for i in range(2, n+1):
+        items.append({'id': i, 'parent_id': 1, 'order': i-2, 'nb_children': 0, 'fav_order': i%7,
+                      'type': 4, 'limit_time': 0, 'add_time': 1650000000+i,
+                      'uuid': str(uuid.uuid4()), 'title': f'Épisode n°{i}'})
+    return items
+
+
+def best_of(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter()-t0)
+    return best
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    items = make_items(n)
+
+    legacy_stream = io.BytesIO()
+    legacy_write(legacy_stream, items)
+    new_stream = io.BytesIO()
+    write_merlin_playlist(new_stream, items)
+    data = new_stream.getvalue()
+    assert data == legacy_stream.getvalue()
+    assert read_merlin_playlist(io.BytesIO(data)) == legacy_read(io.BytesIO(data)) == items
+
+    for name, legacy, new in (
+            ('write', lambda: legacy_write(io.BytesIO(), items), lambda: write_merlin_playlist(io.BytesIO(), items)),
+            ('read', lambda: legacy_read(io.BytesIO(data)), lambda: read_merlin_playlist(io.BytesIO(data)))):
+        t_legacy = best_of(legacy)
+        t_new = best_of(new)
+        print(f"{name:5} {n} items: legacy {t_legacy*1000:8.1f} ms, struct {t_new*1000:8.1f} ms, x{t_legacy/t_new:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare the size and load time of json and binary sessions.
+# Usage: python bench_session_snapshot.py [nb_menus] [nb_sounds_per_menu]
+
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from playlist_model import PlaylistModel
+from session_snapshot import encode_session, decode_session, SessionSnapshot
+
+
+def make_model(nb_menus, nb_sounds):
+    model = PlaylistModel()
+    for m in range(nb_menus):
+        menu_uuid = str(uuid.uuid4())
+        menu = model.insert('', 'end', 6, f'Menu {m}', uuid=menu_uuid, imagepath=f'/home/user/merlin/images/{menu_uuid}.jpg')
+        for s in range(nb_sounds):
+            sound_uuid = str(uuid.uuid4())
+            model.insert(menu.iid, 'end', 4, f'Épisode {s}', uuid=sound_uuid, add_time=1650000000+s,
+                         imagepath='/home/user/merlin/import/merlin.zip', soundpath=f'/home/user/merlin/sounds/{sound_uuid}.mp3')
+    return model
+
+
+def best_of(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter()-t0)
+    return best
+
+
+def main():
+    nb_menus = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nb_sounds = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    model = make_model(nb_menus, nb_sounds)
+    items = model.to_items()
+
+    json_data = json.dumps(items, indent=2).encode('utf-8')
+    binary_data = encode_session(items)
+    assert decode_session(binary_data) == json.loads(json_data) == items
+
+    print(f"{len(items)} items: json {len(json_data)/2**20:6.1f} MB, binary {len(binary_data)/2**20:6.1f} MB")
+    print(f"json load          {best_of(lambda: json.loads(json_data))*1000:8.1f} ms")
+    print(f"binary load        {best_of(lambda: decode_session(binary_data))*1000:8.1f} ms")
+    print(f"binary top level   {best_of(lambda: SessionSnapshot(binary_data).top_level_items())*1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the 
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare sequential full-size thumbnail decoding with the thread pool
+# and JPEG draft-mode decoding (the on-disk cache is not involved).
+# Usage: python bench_thumbnails.py [nb_images]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from PIL import Image
+from io_utils import IsImageProgressive
+from thumbnails import make_thumbnail, decode_thumbnails, THUMBNAIL_SIZE
+
+
+def legacy_thumbnail(imagepath):
+    with open(imagepath, "rb") as imagestream:
+        if IsImageProgressive(imagestream):
+            return None
+    with Image.open(imagepath) as image:
+        return image.resize(THUMBNAIL_SIZE, Image.ANTIALIAS)
+
+
+def make_images(directory, n, size):
+    paths = []
+    for i in range(n):
+        path = os.path.join(directory, f'{size}_{i}.jpg')
+        image = Image.linear_gradient('L').resize((size, size)).convert('RGB').rotate(i % 360)
+        image.save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (128, 512, 1500):
+            paths = make_images(tmp, n if size < 1500 else n//10, size)
+            t0 = time.perf_counter()
+            for path in paths:
+                legacy_thumbnail(path)
+            t_legacy = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            decode_thumbnails({path: (lambda path=path: make_thumbnail(lambda: open(path, 'rb'))) for path in paths})
+            t_new = time.perf_counter() - t0
+            print(f"{len(paths):5} images {size:4}x{size:<4}: sequential {t_legacy:6.2f} s, "
+                  f"pool+draft {t_new:6.2f} s, x{t_legacy/t_new:.1f}")
+
+
+if __name__ == '__main__':
+    main()
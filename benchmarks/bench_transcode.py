@@ -0,0 +1,66 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the 
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare peak memory and wall time of the streaming encoder and of the
+# pydub (whole-file decode) encoder. Needs ffmpeg, Unix only (resource module).
+# Usage: python bench_transcode.py [duration_in_minutes]
+
+import math
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+src_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+
+child_script = """
+import resource, sys
+sys.path.insert(0, {src_dir!r})
+import audio_converter
+getattr(audio_converter, sys.argv[1])(sys.argv[2], sys.argv[3])
+own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+encoder = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print(own, encoder)
+"""
+
+
+def make_wav(path, minutes):
+    rate = 44100
+    period = [int(12000*math.sin(2*math.pi*440*i/rate)) for i in range(rate//10)]
+    frames = struct.pack(f'<{2*len(period)}h', *[v for v in period for _ in range(2)])
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        for _ in range(minutes*60*10):
+            w.writeframes(frames)
+
+
+def run(backend, src, dst):
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', child_script.format(src_dir=src_dir), backend, src, dst], 
+                         check=True, capture_output=True, text=True).stdout.split()
+    elapsed = time.perf_counter() - t0
+    own, encoder = (int(v)/1024 for v in out[-2:])
+    return elapsed, own, encoder
+
+
+def main():
+    minutes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'source.wav')
+        make_wav(src, minutes)
+        print(f"source: {minutes} min stereo wav, {os.path.getsize(src)/1024**2:.0f} MB")
+        for backend in ('pydub_encode', 'stream_encode'):
+            elapsed, own, encoder = run(backend, src, os.path.join(tmp, backend + '.mp3'))
+            print(f"{backend:14} {elapsed:6.1f} s   peak RSS python {own:7.1f} MB, encoder {encoder:6.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
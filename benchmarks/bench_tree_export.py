@@ -0,0 +1,94 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Compare the streaming playlist.bin export of the playlist model with
+# the former recursive list building (time and peak memory).
+# Usage: python bench_tree_export.py [nb_menus] [nb_sounds_per_menu]
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from io_utils import encode_merlin_playlist, write_merlin_playlist
+from playlist_model import PlaylistModel
+
+
+def legacy_subtree_to_list(model, node, order, parent_id, counter):
+    # nested lists extended at every level, as in the former MerlinMainTree.subtree_to_list
+    counter[0] += 1
+    item = model.node_to_item(node, counter[0], parent_id, order, len(node.children), model.fav_order(node))
+    res = [item]
+    for order, child in enumerate(node.children):
+        res.extend(legacy_subtree_to_list(model, child, order, item['id'], counter))
+    return res
+
+
+def legacy_export(model, stream):
+    items = [model.node_to_item(model.root, 1, 0, 0, len(model.root.children), 0)]
+    counter = [1]
+    for order, node in enumerate(model.root.children):
+        items.extend(legacy_subtree_to_list(model, node, order, 1, counter))
+    stream.write(encode_merlin_playlist(items))
+
+
+def make_model(nb_menus, nb_sounds):
+    model = PlaylistModel()
+    for m in range(nb_menus):
+        menu = model.insert('', 'end', 6, f'Menu {m}', uuid=str(uuid.uuid4()))
+        for s in range(nb_sounds):
+            model.insert(menu.iid, 'end', 4, f'Épisode {s}', uuid=str(uuid.uuid4()), add_time=1650000000+s)
+    return model
+
+
+def measure(func, repeat=3):
+    # time without tracing, then peak memory with tracemalloc
+    elapsed = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter()-t0)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    nb_menus = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    nb_sounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    model = make_model(nb_menus, nb_sounds)
+
+    legacy_stream = io.BytesIO()
+    legacy_export(model, legacy_stream)
+    new_stream = io.BytesIO()
+    write_merlin_playlist(new_stream, model.iter_items())
+    assert legacy_stream.getvalue() == new_stream.getvalue()
+
+    t_legacy, m_legacy = measure(lambda: legacy_export(model, io.BytesIO()))
+    t_new, m_new = measure(lambda: write_merlin_playlist(io.BytesIO(), model.iter_items()))
+    print(f"{len(model)} nodes: legacy {t_legacy*1000:8.1f} ms, peak {m_legacy/2**20:6.1f} MB")
+    print(f"{len(model)} nodes: stream {t_new*1000:8.1f} ms, peak {m_new/2**20:6.1f} MB")
+
+    # a chain of nested menus deeper than the recursion limit
+    deep = PlaylistModel()
+    parent = ''
+    for i in range(sys.getrecursionlimit()*2):
+        parent = deep.insert(parent, 'end', 6, f'Menu {i}').iid
+    try:
+        legacy_export(deep, io.BytesIO())
+        print("legacy: deep tree exported")
+    except RecursionError:
+        print("legacy: RecursionError on deep tree")
+    print(f"stream: deep tree exported, {write_merlin_playlist(io.BytesIO(), deep.iter_items())} records")
+
+
+if __name__ == '__main__':
+    main()
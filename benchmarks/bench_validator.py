@@ -0,0 +1,62 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# Time the validation of a card folder, with an empty media index (every header
+# is probed) and with the index filled by the first run.
+# Usage: python bench_validator.py path/to/sound.mp3 [nb_menus] [nb_sounds_per_menu] [jobs]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from PIL import Image
+from io_utils import write_merlin_playlist, load_merlin_playlist
+from media_index import MediaIndex
+from playlist_model import PlaylistModel
+from validator import validate
+
+
+def make_card(directory, soundpath, nb_menus, nb_sounds):
+    imagepath = os.path.join(directory, 'image.jpg')
+    Image.linear_gradient('L').resize((128, 128)).convert('RGB').save(imagepath, "JPEG")
+    model = PlaylistModel()
+    for m in range(nb_menus):
+        menu = model.insert('', 'end', 6, f'Menu {m}', uuid=str(uuid.uuid4()))
+        shutil.copyfile(imagepath, os.path.join(directory, menu.uuid + '.jpg'))
+        for s in range(nb_sounds):
+            sound = model.insert(menu.iid, 'end', 4, f'Épisode {s}', uuid=str(uuid.uuid4()), add_time=1650000000+s)
+            shutil.copyfile(imagepath, os.path.join(directory, sound.uuid + '.jpg'))
+            shutil.copyfile(soundpath, os.path.join(directory, sound.uuid + '.mp3'))
+    os.remove(imagepath)
+    with open(os.path.join(directory, 'playlist.bin'), 'wb') as file:
+        write_merlin_playlist(file, model.iter_items())
+
+
+def main():
+    soundpath = sys.argv[1]
+    nb_menus = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    nb_sounds = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    with tempfile.TemporaryDirectory() as directory:
+        make_card(directory, soundpath, nb_menus, nb_sounds)
+        media_index = MediaIndex(os.path.join(directory, 'media.sqlite'))
+        items = load_merlin_playlist(os.path.join(directory, 'playlist.bin'))
+        print(f"{len(items)} items, {jobs} threads")
+        t0 = time.perf_counter()
+        validate(items, media=False)
+        print(f"tree only     {(time.perf_counter()-t0)*1000:8.1f} ms")
+        for run in ('empty index', 'filled index'):
+            t0 = time.perf_counter()
+            report = validate(items, media_index=media_index, card=True, max_workers=jobs)
+            print(f"{run:13s} {(time.perf_counter()-t0)*1000:8.1f} ms, {report['errors']} errors, {report['warnings']} warnings")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,35 @@
 
 
 #importing libraries 
-from pygame import mixer
+import io
 import time
+import threading
 import tkinter as tk
 from tkinter import ttk
-import zipfile
-from mutagen.mp3 import MP3
+from importlib.util import find_spec
+
+from playback_source import PlaybackSources, SoundPrefetcher
+
+# pygame is slow to import: it is loaded in the background, once the window is shown
+# (see AudioWidget.start_backend); mutagen is used by the media index
+mixer = None
+
+# delay before loading the sound of a new selection (ms), so that browsing with the arrow keys stays fluid
+LOAD_DELAY = 150
+# number of following sounds of the menu read in advance
+PREFETCH_COUNT = 3
+
+
+def audio_available():
+    # checks that the audio libraries are installed, without importing them
+    return find_spec('pygame') is not None and find_spec('mutagen') is not None
+
+
+def import_backend():
+    global mixer
+    from pygame import mixer as pygame_mixer
+    mixer = pygame_mixer
+
 
 class AudioWidget(tk.Frame):
     
@@ -22,13 +45,30 @@ class AudioWidget(tk.Frame):
             self.rootGUI = parent
         else:
             self.rootGUI = root
-        mixer.init()
+        self.backend_thread = None
+        self.backend_ready = False
+        self.backend_error = None
+        self.backend_callback = None
         self.sound = None
+        # streams of the sounds, zip archives are kept open between selections
+        self.sources = PlaybackSources()
+        self.prefetcher = SoundPrefetcher(self.sources, self.rootGUI.media_index)
         self.start_time = 0
         self.pause_time = 0
         self.sound_length = 0
-        self.looping = False
         self.playing = False
+        # selection loading: debounce timer, generation of the current request, worker result
+        self.load_job = None
+        self.load_generation = 0
+        self.load_pending = False
+        self.play_when_loaded = False
+        # play time display, only scheduled while a sound is playing
+        self.poll_job = None
+        # play through menu: node of the current sound, and (node, sound, length, queued in the mixer) of the next one
+        self.node = None
+        self.next_sound = None
+        self.chain_node = None
+        self.chain = tk.BooleanVar(value=False)
     
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=1)
@@ -45,10 +85,50 @@ class AudioWidget(tk.Frame):
         #stop button
         self.stop_button=tk.Button(self,text="Stop",width =8,command=self.Stop, state='disabled')
         self.stop_button.grid(row=1,column=1)
+        #play through menu
+        self.chain_button = tk.Checkbutton(self, text="Enchaîner", variable=self.chain)
+        self.chain_button.grid(row=2, column=0, columnspan=2, sticky='w')
         
         self.slider.bind('<Button-1>', self.conditionalPause)
         self.slider.bind("<ButtonRelease-1>", self.conditionalResume)
     
+    def start_backend(self, callback=None):
+        # import the audio libraries in a thread, the mixer is then initialized from the Tk thread
+        self.backend_callback = callback
+        self.backend_thread = threading.Thread(target=self.import_backend, daemon=True)
+        self.backend_thread.start()
+        self.after(50, self.check_backend)
+    
+    def import_backend(self):
+        try:
+            import_backend()
+        except Exception as error:
+            self.backend_error = error
+    
+    def check_backend(self):
+        if self.backend_thread.is_alive():
+            self.after(50, self.check_backend)
+        else:
+            self.ensure_backend()
+    
+    def ensure_backend(self):
+        # returns True when audio can be played, waits for the libraries if they are still loading
+        if self.backend_ready or self.backend_error:
+            return self.backend_ready
+        if self.backend_thread is None:
+            self.import_backend()
+        else:
+            self.backend_thread.join()
+        if self.backend_error is None:
+            try:
+                mixer.init()
+                self.backend_ready = True
+            except Exception as error:
+                self.backend_error = error
+        if self.backend_callback:
+            self.backend_callback()
+        return self.backend_ready
+    
     def slider_action(self, pos):
         position = self.slider.get()
         if self.start_time:
@@ -62,7 +142,7 @@ class AudioWidget(tk.Frame):
                 mixer.music.play(start=position)
             
         
-    def update_play_time(self):
+    def show_play_time(self):
         total_time = time.strftime("%M:%S", time.gmtime(self.sound_length))
         if self.start_time:
             if self.pause_time:
@@ -74,12 +154,38 @@ class AudioWidget(tk.Frame):
         elapsed_time = time.strftime("%M:%S", time.gmtime(current_time))
         self.slider_label.config(text=f"{elapsed_time} / {total_time}")
         self.slider.config(value=current_time)
-        self.after(200, self.update_play_time)
-            
+        return current_time
+    
+    def update_play_time(self):
+        current_time = self.show_play_time()
+        if self.start_time and not self.pause_time and current_time > self.sound_length:
+            if self.next_sound and self.chain.get() and (self.next_sound[3] or not mixer.music.get_busy()):
+                self.advance()
+            elif (self.next_sound and self.next_sound[3]) or not mixer.music.get_busy():
+                # end of the sound, a sound already queued is not played if the play through has been unchecked
+                self.Stop()
+        if self.start_time and not self.pause_time and self.chain.get() and self.next_sound is None:
+            self.queue_next()
+        if self.start_time and not self.pause_time:
+            self.poll_job = self.after(200, self.update_play_time)
+        else:
+            self.poll_job = None
+    
+    def start_polling(self):
+        if self.poll_job is None:
+            self.update_play_time()
+    
     
     def init(self):
+        # called on each selection: the widget is reset at once, the sound is loaded
+        # in a worker once the selection has settled
         main_tree = self.rootGUI.main_tree
         selected_node = main_tree.selection()
+        if self.chain_node is not None and selected_node == (self.chain_node,):
+            # selection of the sound that follows in the play through menu
+            self.chain_node = None
+            return
+        self.chain_node = None
         self.Stop()
         if self.sound:
             self.sound.close()
@@ -87,63 +193,196 @@ class AudioWidget(tk.Frame):
         self.pause_time = 0
         self.sound = None
         self.sound_length = 0
-            
+        self.node = None
+        self.play_when_loaded = False
+        self.play_button['state'] = 'disabled'
+        self.stop_button['state'] = 'disabled'
+        self.slider.config(to=0)
+        self.show_play_time()
+        
+        self.load_generation += 1
+        if self.load_job is not None:
+            self.after_cancel(self.load_job)
+            self.load_job = None
         if selected_node and main_tree.tag_has('sound', selected_node) and main_tree.set(selected_node, 'soundpath'):
-            soundpath = main_tree.set(selected_node, 'soundpath')
+            request = (self.load_generation, selected_node, main_tree.set(selected_node, 'soundpath'),
+                       main_tree.set(selected_node, 'uuid'))
+            prefetched = self.prefetcher.get(request[2], request[3])
+            if prefetched:
+                # already in memory, no need to wait
+                data, sound_length = prefetched
+                self.load_pending = True
+                self.check_loading(request, [(io.BytesIO(data), sound_length)])
+                return
+            self.load_pending = True
+            self.load_job = self.after(LOAD_DELAY, self.start_loading, request)
+        else:
+            self.load_pending = False
+    
+    def start_loading(self, request):
+        self.load_job = None
+        result = []
+        threading.Thread(target=self.load_sound, args=(request, result), daemon=True).start()
+        self.after(20, self.check_loading, request, result)
+    
+    def load_sound(self, request, result):
+        # worker: the duration comes from the media index, the sound is read for playing
+        generation, _, soundpath, uuid = request
+        sound = None
+        try:
+            media_index = self.rootGUI.media_index
             if soundpath[-4:] == '.zip':
-                filename = main_tree.set(selected_node, 'uuid') + '.mp3'
-                with zipfile.ZipFile(soundpath, 'r') as z:
-                    zippath = zipfile.Path(z, at=filename)
-                    if zippath.exists():
-                        self.sound = z.open(filename, 'r')
-                        sound_mut = MP3(self.sound)
-                        self.sound_length = sound_mut.info.length
-                        self.sound.close()
-                        self.sound = z.open(filename, 'r')
+                # the archive stays open in the pool, the member is read in place or from the spill cache
+                filename = uuid + '.mp3'
+                archive = self.sources.archive(soundpath)
+                try:
+                    sound_length = media_index.sound_info(soundpath, filename, zfile=archive.zfile)['duration']
+                    sound = self.sources.open(soundpath, filename)
+                finally:
+                    archive.release()
             else:
-                self.sound = open(soundpath, 'rb')
-                sound_mut = MP3(self.sound)
-                self.sound_length = sound_mut.info.length
-                self.sound.close()
-                self.sound = open(soundpath, 'r')
-            
-            self.slider.config(to=self.sound_length)
+                sound_length = media_index.sound_info(soundpath)['duration']
+                sound = self.sources.open(soundpath)
+            result.append((sound, sound_length))
+        except Exception as error:
+            # missing or unreadable sound
+            if sound is not None:
+                sound.close()
+            result.append((None, error))
+    
+    def check_loading(self, request, result):
+        if not result:
+            self.after(20, self.check_loading, request, result)
+            return
+        sound, sound_length = result[0]
+        generation, node, _, _ = request
+        main_tree = self.rootGUI.main_tree
+        if generation != self.load_generation or main_tree.selection() != node:
+            # the selection has changed meanwhile
+            if sound is not None:
+                sound.close()
+            return
+        self.load_pending = False
+        if sound is None:
+            return
+        self.sound = sound
+        self.sound_length = sound_length
+        self.node = node[0]
+        self.slider.config(to=self.sound_length)
+        self.show_play_time()
+        self.prefetch_next(self.node)
+        if not self.backend_error:
             self.play_button['state'] = 'normal'
-        else:
-            self.play_button['state'] = 'disabled'
-            self.slider.config(to=0)
-                
-        self.stop_button['state'] = 'disabled'
-        if not self.looping:
-                self.update_play_time()
-                self.looping = True
-            
+            if self.play_when_loaded:
+                self.Play()
+        self.play_when_loaded = False
             
     
+    def next_sounds(self, node, count):
+        # the sounds that follow node in its menu
+        main_tree = self.rootGUI.main_tree
+        res = []
+        node = main_tree.next(node)
+        while node and len(res) < count:
+            if main_tree.tag_has('sound', node) and main_tree.set(node, 'soundpath'):
+                res.append(node)
+            node = main_tree.next(node)
+        return res
+    
+    def prefetch_next(self, node):
+        main_tree = self.rootGUI.main_tree
+        self.prefetcher.prefetch([(main_tree.set(n, 'soundpath'), main_tree.set(n, 'uuid'))
+                                  for n in self.next_sounds(node, PREFETCH_COUNT)])
+    
+    def queue_next(self):
+        # the next sound of the menu is queued in the mixer, so that it starts without gap
+        # it must have been prefetched, otherwise this is tried again at the next poll
+        main_tree = self.rootGUI.main_tree
+        following = self.next_sounds(self.node, 1) if self.node else []
+        if not following:
+            return
+        node = following[0]
+        prefetched = self.prefetcher.get(main_tree.set(node, 'soundpath'), main_tree.set(node, 'uuid'))
+        if prefetched is None:
+            return
+        data, sound_length = prefetched
+        try:
+            mixer.music.queue(io.BytesIO(data))
+            queued = True
+        except Exception:
+            # older pygame: the sound is loaded at the end of the current one
+            queued = False
+        self.next_sound = (node, io.BytesIO(data), sound_length, queued)
+    
+    def advance(self):
+        # the current sound is over, the next one of the menu becomes the current one
+        node, sound, sound_length, queued = self.next_sound
+        self.next_sound = None
+        if queued:
+            self.start_time += self.sound_length
+        else:
+            mixer.music.load(sound)
+            mixer.music.play()
+            self.start_time = time.time()
+        if self.sound:
+            self.sound.close()
+        self.sound = sound
+        self.sound_length = sound_length
+        self.node = node
+        self.slider.config(to=self.sound_length)
+        main_tree = self.rootGUI.main_tree
+        self.chain_node = node
+        main_tree.selection_set(node)
+        main_tree.see(node)
+        self.prefetch_next(node)
+    
+    def close(self):
+        if self.sound:
+            self.sound.close()
+        self.prefetcher.close()
+        self.sources.close()
+    
+    
     def Play(self):
         if self.sound:
+            if not self.ensure_backend():
+                return
+            self.next_sound = None
+            self.sound.seek(0)
             mixer.music.load(self.sound)
             self.pause_time = 0
             self.start_time = time.time()
             mixer.music.play()
             self.stop_button['state'] = 'normal'
+            if self.chain.get():
+                self.queue_next()
+            self.start_polling()
+        elif self.load_pending:
+            # double click: played as soon as it is loaded
+            self.play_when_loaded = True
             
     def Pause(self):
         self.pause_time = time.time()
         mixer.music.pause()
+        self.show_play_time()
     
     def Stop(self):
+        self.next_sound = None
+        if not self.backend_ready:
+            return
         mixer.music.stop()
         if self.start_time:
             self.start_time = 0
             self.pause_time = 0
             self.stop_button['state'] = 'disabled'
+            self.show_play_time()
         
     def Resume(self):
         delta = time.time() - self.pause_time
         self.pause_time = 0
         self.start_time += delta
         mixer.music.unpause()
+        self.start_polling()
         
             
     def PlayStop(self, event=None):
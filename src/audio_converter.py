@@ -1,9 +1,259 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the 
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
 
-from pydub import AudioSegment
 
+import os, shutil, sys
+import subprocess
+import hashlib
+import logging
+import threading
+import time
 
-def mp3_encode(file):
+
+# encoding parameters of the Merlin sounds
+ENCODE_BITRATE = "128k"
+ENCODE_CHANNELS = 2
+ENCODE_SAMPLE_RATE = 44100
+CHUNK_SIZE = 64*1024
+
+
+def must_convert(filepath, media_index=None):
+    # the format is read from the media index, shared with the GUI and the other workers
+    from media_index import MediaIndex
+    try:
+        audio = (media_index or MediaIndex()).sound_info(filepath)
+        if audio['bitrate'] == 128000 and audio['channels'] == 2 and audio['sample_rate'] == 44100:
+            return False
+    except Exception:
+        pass
+    return True
+
+
+def find_encoder():
+    for name in ('ffmpeg', 'avconv'):
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+
+def make_temp_file(directory, suffix):
+    # as tempfile.mkstemp, but with the permissions of a file created by open(), the kernel applies the umask
+    # (mkstemp creates its files readable by their owner only)
+    while True:
+        temppath = os.path.join(directory, 'tmp' + os.urandom(8).hex() + suffix)
+        try:
+            return os.open(temppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), temppath
+        except FileExistsError:
+            continue
+
+
+def pydub_encode(filepath, new_filepath):
+    # decodes the whole file in memory
+    from pydub import AudioSegment
+    AudioSegment.from_file(filepath).export(new_filepath, format="mp3", bitrate=ENCODE_BITRATE, 
+                                            parameters=["-ac", str(ENCODE_CHANNELS), "-ar", str(ENCODE_SAMPLE_RATE)])
+
+
+def stream_encode(filepath, new_filepath, encoder=None):
+    # pipe the source through the encoder process chunk by chunk,
+    # so that memory use does not depend on the length of the track
+    encoder = encoder or find_encoder()
+    command = [encoder, '-hide_banner', '-loglevel', 'error', '-nostdin', '-i', filepath, '-vn', 
+               '-ac', str(ENCODE_CHANNELS), '-ar', str(ENCODE_SAMPLE_RATE), '-b:a', ENCODE_BITRATE, 
+               '-f', 'mp3', 'pipe:1']
+    tempdir = os.path.dirname(new_filepath) or '.'
+    fd, temppath = make_temp_file(tempdir, '.part')
+    try:
+        with os.fdopen(fd, 'wb') as fout, \
+             subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+            # stderr is drained in a thread so that a verbose encoder cannot block on a full pipe
+            stderr = []
+            stderr_thread = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+            stderr_thread.start()
+            while (chunk := process.stdout.read(CHUNK_SIZE)):
+                fout.write(chunk)
+            returncode = process.wait()
+            stderr_thread.join()
+        if returncode:
+            message = b''.join(stderr).decode('UTF-8', errors='replace').strip()
+            raise IOError(f"encoding of '{filepath}' failed: {message}")
+        os.replace(temppath, new_filepath)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+
+def mp3_encode(filepath, new_filepath):
+    encoder = find_encoder()
+    if encoder:
+        stream_encode(filepath, new_filepath, encoder)
+    else:
+        pydub_encode(filepath, new_filepath)
+
+
+def default_cache_dir():
+    if 'MERLINATOR_CACHE_DIR' in os.environ:
+        return os.environ['MERLINATOR_CACHE_DIR']
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'merlinator')
+
+
+class TranscodeCache:
+    # encoded sounds, keyed by the hash of the source content and of the encoding parameters
+    # the least recently used entries are evicted when the cache exceeds max_size bytes
+    # entries are hard linked to the exported sounds: their use is recorded in the access time,
+    # the modification time is the one of the user's files and is left as it is
+    
+    def __init__(self, directory=None, max_size=2*1024**3):
+        self.directory = os.path.join(directory or default_cache_dir(), 'transcode')
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+    
+    def key(self, filepath):
+        h = hashlib.sha256(f"{ENCODE_BITRATE}/{ENCODE_CHANNELS}/{ENCODE_SAMPLE_RATE}\n".encode('UTF-8'))
+        with open(filepath, 'rb') as file:
+            while (chunk := file.read(1024*1024)):
+                h.update(chunk)
+        return h.hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.directory, key + '.mp3')
+    
+    def get(self, key, new_filepath):
+        # hard link (or copy) the cached output to new_filepath, returns False on a cache miss
+        cachepath = self.path(key)
+        try:
+            stat = os.stat(cachepath)
+            os.utime(cachepath, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            return False
+        try:
+            os.link(cachepath, new_filepath)
+        except OSError:
+            shutil.copyfile(cachepath, new_filepath)
+        return True
+    
+    def put(self, key, filepath):
+        # the cached file is hard linked to the exported sounds, it gets their permissions
+        fd, temppath = make_temp_file(self.directory, '.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(filepath, temppath)
+            os.replace(temppath, self.path(key))
+        except OSError:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+        self.evict()
+    
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.mp3'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for atime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def transcode(filepath, new_filepath, cache_dir=None):
+    # convert to the Merlin format (mp3 128k stereo 44.1kHz), or simply copy if already compliant
+    if must_convert(filepath):
+        try:
+            cache = TranscodeCache(cache_dir)
+            key = cache.key(filepath)
+        except OSError:
+            cache = None
+        if cache and cache.get(key, new_filepath):
+            logging.warning("reused cached encoding of %s for %s", filepath, new_filepath)
+            return new_filepath
+        mp3_encode(filepath, new_filepath)
+        logging.warning("encoded %s to %s", filepath, new_filepath)
+        if cache:
+            try:
+                cache.put(key, new_filepath)
+            except OSError:
+                logging.warning("could not cache encoding of %s", filepath)
+    else:
+        shutil.copyfile(filepath, new_filepath)
+        logging.warning("copied %s to %s", filepath, new_filepath)
+    return new_filepath
+
+
+def remove_output(future, new_filepath):
+    if os.path.exists(new_filepath):
+        os.remove(new_filepath)
+
+
+class TranscodePool:
+    # spread a list of (source, destination) transcoding jobs across processes
+    # finished jobs are collected with poll(), from the GUI thread
+    
+    def __init__(self, jobs, max_workers=None, cache_dir=None):
+        # imported on first use, it is slow to import and not needed at startup
+        from concurrent.futures import ProcessPoolExecutor
+        self.jobs = list(jobs)
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.finished = []
+        self.delivered = set()
+        # at least one worker, ProcessPoolExecutor refuses 0 when there is no job
+        self.executor = ProcessPoolExecutor(max_workers=max_workers or max(1, min(len(self.jobs), os.cpu_count() or 1)))
+        self.futures = []
+        for index, (filepath, new_filepath) in enumerate(self.jobs):
+            future = self.executor.submit(transcode, filepath, new_filepath, cache_dir)
+            future.add_done_callback(lambda f, index=index: self.job_done(index, f))
+            self.futures.append(future)
+    
+    def job_done(self, index, future):
+        with self.lock:
+            if not future.cancelled():
+                self.finished.append((index, future.exception()))
+    
+    def poll(self):
+        # returns the list of (job index, exception or None) finished since the last call
+        with self.lock:
+            if self.cancelled:
+                return []
+            finished, self.finished = self.finished, []
+        self.delivered.update(index for index, error in finished)
+        return finished
+    
+    def done(self):
+        return self.cancelled or len(self.delivered) == len(self.jobs)
+    
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+        for index, (future, (filepath, new_filepath)) in enumerate(zip(self.futures, self.jobs)):
+            if index in self.delivered:
+                continue
+            if not future.cancel():
+                # already running or finished but not collected: discard its output
+                future.add_done_callback(lambda f, path=new_filepath: remove_output(f, path))
+        self.executor.shutdown(wait=False, cancel_futures=True)
     
-    sound = AudioSegment.from_mp3(file, channels=1)
-    sound.sample_width, sound.frame_rate, sound.channels, sound.frame_width
-    
\ No newline at end of file
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,266 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# command line interface, without Tk
+# each command imports only the modules it needs, so that quick commands start fast
+
+import argparse
+import os.path
+import sys
+
+
+SESSION_EXTENSIONS = ('.json', '.mls')
+
+
+def is_session(path):
+    return os.path.splitext(path)[1].lower() in SESSION_EXTENSIONS
+
+
+def read_items(path):
+    # items of a session, a playlist.bin, a zip archive, or a card folder
+    if os.path.isdir(path):
+        path = os.path.join(path, 'playlist.bin')
+    if is_session(path):
+        from session_journal import read_session
+        return read_session(path)
+    from io_utils import load_merlin_playlist
+    return load_merlin_playlist(path)
+
+
+def read_model(path):
+    from playlist_model import PlaylistModel
+    return PlaylistModel.from_items(read_items(path))
+
+
+def print_missing(files_not_found):
+    for f in files_not_found:
+        print(f"fichier non trouvé: {f}", file=sys.stderr)
+
+
+def find_menu(model, menu_path):
+    # iid of the menu designated by its titles, separated by '/'
+    iid = ''
+    for title in filter(None, menu_path.split('/')):
+        for node in model.children(iid):
+            if node.title == title and node.is_directory():
+                iid = node.iid
+                break
+        else:
+            raise SystemExit(f"menu non trouvé: {menu_path}")
+    return iid
+
+
+def cmd_import(args):
+    from playlist_model import PlaylistModel
+    from session_journal import write_session
+    model = PlaylistModel()
+    if args.merge and os.path.exists(args.session):
+        model.add_items(read_items(args.session))
+    report = model.add_items(read_items(args.source), merge=args.merge)
+    write_session(args.session, model)
+    print(f"{len(report['added'])} éléments ajoutés, {len(report['matched'])} éléments communs")
+    return 0
+
+
+def cmd_export_bin(args):
+    from io_utils import patch_merlin_playlist
+    model = read_model(args.source)
+    written = patch_merlin_playlist(args.output, model.iter_items())
+    print(f"{written} enregistrements écrits")
+    return 0
+
+
+def cmd_export_zip(args):
+    import zipfile
+    from io_utils import export_merlin_to_zip
+    model = read_model(args.source)
+    with zipfile.ZipFile(args.output, 'w') as zfile:
+        files_not_found = export_merlin_to_zip(model.iter_items(), zfile)
+    print_missing(files_not_found)
+    return 1 if files_not_found else 0
+
+
+def cmd_sync(args):
+    from io_utils import sync_merlin_to_directory
+    model = read_model(args.source)
+    report = sync_merlin_to_directory(model.to_items(), args.directory, args.delete_orphans,
+                                      args.check_hash, args.jobs)
+    print(f"{len(report['copied'])} fichiers copiés, {report['skipped']} à jour, "
+          f"{len(report['deleted'])} supprimés")
+    print_missing(report['files_not_found'])
+    for filename, error in report['failed']:
+        print(f"erreur: {filename}: {error}", file=sys.stderr)
+    if not report['playlist_written']:
+        print("playlist.bin n'a pas été écrit, la carte n'est pas à jour", file=sys.stderr)
+    elif args.delete_orphans and report['orphans'] and not report['deleted']:
+        print("le dossier ne contenait pas de playlist.bin, les fichiers orphelins n'ont pas été supprimés", file=sys.stderr)
+    return 1 if report['files_not_found'] or report['failed'] or not report['playlist_written'] else 0
+
+
+def cmd_validate(args):
+    import json
+    from validator import validate
+    status = 0
+    reports = dict()
+    for path in args.paths:
+        try:
+            # the media of a card or an archive are checked as they are, those of a session as they will be exported
+            report = validate(read_items(path), media=not args.no_media, card=not is_session(path), max_workers=args.jobs)
+        except Exception as e:
+            # unreadable or malformed file
+            report = {'items': 0, 'errors': 1, 'warnings': 0,
+                      'issues': [{'level': 'error', 'check': 'unreadable', 'id': None, 'title': '', 'message': f"lecture impossible: {e}"}]}
+        reports[path] = report
+        if report['errors']:
+            status = 1
+        if not args.json:
+            for i in report['issues']:
+                print(f"{path}: {i['level']}: {i['id']} '{i['title']}': {i['message']}")
+            print(f"{path}: {report['items']} éléments, {report['errors']} erreurs, {report['warnings']} avertissements")
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    return status
+
+
+def cmd_add_sounds(args):
+    import time
+    import uuid
+    from io_utils import find_common_prefix_and_suffix, shorten_filename
+    from audio_converter import TranscodePool
+    from session_journal import write_session
+    model = read_model(args.session)
+    parent = find_menu(model, args.menu)
+    dest = args.dest or os.path.dirname(os.path.abspath(args.session))
+    common_prefix, common_suffix = find_common_prefix_and_suffix(args.files)
+    jobs = []
+    new_items = []
+    for filepath in args.files:
+        new_uuid = str(uuid.uuid4())
+        jobs.append((filepath, os.path.join(dest, new_uuid + '.mp3')))
+        new_items.append((shorten_filename(filepath, common_prefix, common_suffix), new_uuid))
+
+    pool = TranscodePool(jobs, max_workers=args.jobs)
+    errors = dict()
+    try:
+        while not pool.done():
+            for index, error in pool.poll():
+                if error is not None:
+                    errors[index] = error
+            time.sleep(0.05)
+    finally:
+        pool.shutdown()
+    # sounds are added in the order of the command line
+    for index, (filepath, new_filepath) in enumerate(jobs):
+        if index in errors:
+            print(f"erreur de conversion: {filepath}: {errors[index]}", file=sys.stderr)
+            continue
+        display_name, new_uuid = new_items[index]
+        model.insert(parent, 'end', 4, display_name, uuid=new_uuid, soundpath=new_filepath, add_time=int(time.time()))
+    write_session(args.session, model)
+    return 1 if errors else 0
+
+
+def print_tree(children):
+    # indented tree, in the order of the menus
+    # children(parent_id) returns the items of a menu, sorted by order
+    stack = [(item, 0) for item in reversed(children(0))]
+    while stack:
+        item, depth = stack.pop()
+        marker = '+' if item['type']%32 in [2, 6, 10, 18] or item['type'] == 1 else '-'
+        fav = f" ♥{item['fav_order']}" if item['fav_order'] else ''
+        print(f"{'  '*depth}{marker} {item['title']} [{item['uuid']}]{fav}")
+        stack.extend((child, depth+1) for child in reversed(children(item['id'])))
+
+
+def cmd_dump(args):
+    path = os.path.join(args.source, 'playlist.bin') if os.path.isdir(args.source) else args.source
+    if not args.json and not is_session(path) and path[-4:] != '.zip':
+        # a playlist.bin is mapped, only the records that are printed are decoded
+        from io_utils import PlaylistView
+        with PlaylistView(path) as view:
+            print_tree(view.children)
+        return 0
+    items = read_items(args.source)
+    if args.json:
+        import json
+        json.dump(items, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return 0
+    children = dict()
+    for item in items:
+        children.setdefault(item['parent_id'], []).append(item)
+    for siblings in children.values():
+        siblings.sort(key=lambda item: item['order'])
+    print_tree(lambda parent_id: children.get(parent_id, []))
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='merlinator', description="Éditeur de playlist pour la Merlin, en ligne de commande.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('import', help="créer ou compléter une session depuis un playlist.bin, une archive zip ou un dossier de carte")
+    p.add_argument('source')
+    p.add_argument('session', help="fichier de session (.json ou .mls)")
+    p.add_argument('--merge', action='store_true', help="fusionner avec la session existante")
+    p.set_defaults(func=cmd_import)
+
+    p = commands.add_parser('export-bin', help="écrire le playlist.bin d'une session")
+    p.add_argument('source')
+    p.add_argument('output')
+    p.set_defaults(func=cmd_export_bin)
+
+    p = commands.add_parser('export-zip', help="créer une archive avec la playlist, les images et les sons")
+    p.add_argument('source')
+    p.add_argument('output')
+    p.set_defaults(func=cmd_export_zip)
+
+    p = commands.add_parser('sync', help="synchroniser un dossier de carte SD")
+    p.add_argument('source')
+    p.add_argument('directory')
+    p.add_argument('--delete-orphans', action='store_true', help="supprimer les fichiers qui ne sont plus dans la playlist")
+    p.add_argument('--check-hash', action='store_true', help="comparer le contenu des fichiers, pas seulement taille et date")
+    p.add_argument('--jobs', type=int, default=4)
+    p.set_defaults(func=cmd_sync)
+
+    p = commands.add_parser('validate', help="vérifier des playlists, archives, sessions ou dossiers de carte")
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--json', action='store_true', help="rapport au format json")
+    p.add_argument('--no-media', action='store_true', help="ne pas vérifier le format des images et des sons")
+    p.add_argument('--jobs', type=int, default=8)
+    p.set_defaults(func=cmd_validate)
+
+    p = commands.add_parser('add-sounds', help="ajouter des sons à une session")
+    p.add_argument('session')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--menu', default='', help="menu de destination, titres séparés par '/'")
+    p.add_argument('--dest', help="dossier des sons convertis, par défaut celui de la session")
+    p.add_argument('--jobs', type=int, default=None)
+    p.set_defaults(func=cmd_add_sounds)
+
+    p = commands.add_parser('dump', help="afficher le contenu d'une playlist")
+    p.add_argument('source')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_dump)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except BrokenPipeError:
+        # output closed early, as with 'merlinator dump playlist.bin | head'
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except IOError as e:
+        print(f"Fichier non accessible: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
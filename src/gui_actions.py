@@ -5,28 +5,29 @@
 # that should have been included as part of this package.
 
 import tkinter as tk
+from tkinter import ttk
 
 class GUIActions(tk.Tk):
 
     def on_closing(self):
         if tk.messagebox.askokcancel("Quitter", "Voulez vous quitter merlinator?"):
-            if self.sessionfile and not self.sessionfile.closed:
-                self.sessionfile.close()
-            if self.enable_audio and self.audio_widget.sound:
-                self.audio_widget.sound.close()
+            if self.journal and self.journal.nb_records:
+                # fold the edits into the session file, so that it opens without replay
+                try:
+                    self.journal.compact()
+                except IOError:
+                    pass
+            self.close_journal()
+            self.media_index.cancel_fill()
+            if self.enable_audio:
+                self.audio_widget.close()
             self.quit()
             self.destroy()
             
     def setTitle(self, *args):
         title = self.title_entry.get()
-        node = self.main_tree.selection()
-        if self.main_tree.tag_has("directory", node):
-            title = ' \u25AE ' + title
-        else:
-            title = ' \u266A ' + title
-        self.main_tree.item(node, text=title)
-        if self.fav_tree.exists(node):
-            self.fav_tree.item(node, text=title)
+        node = self.main_tree.selected()
+        self.main_tree.rename(node, title)
             
             
             
@@ -148,5 +149,26 @@ class TwoButtonCancelDialog(tk.simpledialog.Dialog):
         self.cancel_button.pack(fill= tk.NONE, expand=True, side=tk.RIGHT)
         self.bind("<Escape>", lambda event: self.button_pressed(2))
         self.bind("<Return>", lambda event: self.focus_get().invoke() if hasattr(self.focus_get(), 'invoke') else None)
+
+
+
+class ProgressDialog(tk.Toplevel):
+    def __init__(self, parent, title, maximum, cancel_command):
+        super().__init__(parent)
+        self.title(title)
+        self.transient(parent)
+        self.resizable(False, False)
+        self.maximum = maximum
+        self.label = tk.Label(self, width=40, text=f"0 / {maximum}")
+        self.label.pack(padx=5, pady=5)
+        self.progressbar = ttk.Progressbar(self, orient='horizontal', length=300, maximum=maximum)
+        self.progressbar.pack(padx=5, pady=5)
+        self.cancel_button = tk.Button(self, text='Annuler', width=12, command=cancel_command)
+        self.cancel_button.pack(pady=5)
+        self.protocol("WM_DELETE_WINDOW", cancel_command)
+        self.bind("<Escape>", lambda event: cancel_command())
+        self.grab_set()
         
-       
+    def set_progress(self, value, text=None):
+        self.progressbar['value'] = value
+        self.label.config(text=text or f"{value} / {self.maximum}")
@@ -5,137 +5,291 @@
 # that should have been included as part of this package.
 
 
-from tkinter import Tk, filedialog, messagebox
-from PIL import Image
-from PIL.ImageTk import PhotoImage
 import zipfile
-import os.path
-import json
+import os.path, shutil, sys
+import json, io
 import struct
+import mmap
+import threading
+from time import mktime
+import zlib
 
 
 bytezero = b'\x00'
 info = b"ChouetteRadio"
 
+# playlist.bin record layout (152 bytes, little endian):
+# id, parent_id, order, nb_children, fav_order, type (uint16),
+# limit_time, add_time (uint32),
+# uuid (length byte + 64 bytes), title (length byte + 66 bytes)
+playlist_record = struct.Struct('<6H2IB64sB66s')
+RECORD_SIZE = playlist_record.size
+PLAYLIST_FIELDS = ('id', 'parent_id', 'order', 'nb_children', 'fav_order', 'type', 'limit_time', 'add_time')
+
+
+def decode_merlin_record(fields):
+    (id, parent_id, order, nb_children, fav_order, item_type, limit_time, add_time,
+     uuid_len, uuid, title_len, title) = fields
+    return {'id': id, 'parent_id': parent_id, 'order': order, 'nb_children': nb_children,
+            'fav_order': fav_order, 'type': item_type, 'limit_time': limit_time, 'add_time': add_time,
+            'uuid': uuid[:uuid_len].decode('UTF-8'),
+            'title': title[:title_len].decode('UTF-8')}
+
+
+def decode_merlin_playlist(data):
+    if len(data) % RECORD_SIZE:
+        raise Exception("wrong file format")
+    return [decode_merlin_record(fields) for fields in playlist_record.iter_unpack(data)]
+
 
 def read_merlin_playlist(stream):
+    return decode_merlin_playlist(stream.read())
 
-    items = []
-    while (b:=stream.read(2)):
-        
-        item = dict()
-        # id
-        if not b: raise Exception("wrong file format")
-        item['id'] = int.from_bytes(b, byteorder='little')
-        
-        # id du parent
-        b = stream.read(2)
-        if not b: raise Exception("wrong file format")
-        item['parent_id'] = int.from_bytes(b, byteorder='little')
-        
-        # ordre
-        b = stream.read(2)
-        if not b: raise Exception("wrong file format")
-        item['order'] = int.from_bytes(b, byteorder='little')
-        
-        # nb_enfants
-        b = stream.read(2)
-        if not b: raise Exception("wrong file format")
-        item['nb_children'] = int.from_bytes(b, byteorder='little')
-        
-        # ordre dans les favoris
-        b = stream.read(2)
-        if not b: raise Exception("wrong file format")
-        item['fav_order'] = int.from_bytes(b, byteorder='little')
-        
-        # type d'item
-        b = stream.read(2)
-        if not b: raise Exception("wrong file format")
-        item['type'] = int.from_bytes(b, byteorder='little')
-        
-        # date limite
-        b = stream.read(4)
-        if not b: raise Exception("wrong file format")
-        item['limit_time'] = int.from_bytes(b, byteorder='little')
-        
-        # date d'ajout
-        b = stream.read(4)
-        if not b: raise Exception("wrong file format")
-        item['add_time'] = int.from_bytes(b, byteorder='little')
-        
-        # uuid (nom de fichier)
-        b = stream.read(1)
-        if not b: raise Exception("wrong file format")
-        length = int.from_bytes(b, byteorder='little')
-        b = stream.read(length)
-        item['uuid'] = b.decode('UTF-8')
-        b = stream.read(64-length)
-        
-        # titre
-        b = stream.read(1)
-        if not b: raise Exception("wrong file format")
-        length = int.from_bytes(b, byteorder='little')
-        b = stream.read(length)
-        item['title'] = b.decode('UTF-8')
-        b = stream.read(66-length)
-        
-        items.append(item)
-    return items
 
+def truncate_utf8(data, size):
+    # at most size bytes of UTF-8 encoded data, without cutting a character
+    return data[:size].decode('UTF-8', errors='ignore').encode('UTF-8')
 
 
-def write_merlin_playlist(stream, items):
-    
+def pack_merlin_record(buffer, offset, item):
+    # struct would silently cut the strings but keep their full length:
+    # a long title is shortened, a uuid that does not fit cannot name the files of the item
+    uuid = item['uuid'].encode('UTF-8')
+    if len(uuid) > 64:
+        raise ValueError(f"uuid of more than 64 bytes: {item['uuid']}")
+    title = truncate_utf8(item['title'].encode('UTF-8'), 66)
+    playlist_record.pack_into(buffer, offset,
+                              item['id'], item['parent_id'], item['order'], item['nb_children'],
+                              item['fav_order'], item['type'], item['limit_time'], item['add_time'],
+                              len(uuid), uuid, len(title), title)
+
+
+def encode_merlin_playlist(items):
+    items = items if isinstance(items, (list, tuple)) else list(items)
+    buffer = bytearray(RECORD_SIZE*len(items))
+    for index, item in enumerate(items):
+        pack_merlin_record(buffer, index*RECORD_SIZE, item)
+    return buffer
+
+
+def write_merlin_playlist(stream, items, chunk_records=512):
+    # items can be any iterable, records are packed and written by chunks
+    # returns the number of records written
+    buffer = bytearray(RECORD_SIZE*chunk_records)
+    count = 0
+    offset = 0
     for item in items:
+        pack_merlin_record(buffer, offset, item)
+        offset += RECORD_SIZE
+        count += 1
+        if offset == len(buffer):
+            stream.write(buffer)
+            offset = 0
+    if offset:
+        stream.write(memoryview(buffer)[:offset])
+    return count
+    
 
-        # id
-        b = item['id'].to_bytes(2,byteorder='little')
-        stream.write(b)
-        
-        # id du parent
-        b = item['parent_id'].to_bytes(2, byteorder='little')
-        stream.write(b)
-        
-        # ordre
-        b = item['order'].to_bytes(2, byteorder='little')
-        stream.write(b)
-        
-        # nb_enfants
-        b = item['nb_children'].to_bytes(2, byteorder='little')
-        stream.write(b)
-        
-        # ordre dans les favoris
-        b = item['fav_order'].to_bytes(2, byteorder='little')
-        stream.write(b)
-        
-        # type d'item
-        b = item['type'].to_bytes(2, byteorder='little')
-        stream.write(b)
-        
-        # date limite
-        b = item['limit_time'].to_bytes(4, byteorder='little')
-        stream.write(b)
-        
-        # date d'ajout
-        b = item['add_time'].to_bytes(4, byteorder='little')
-        stream.write(b)
-        
-        # uuid (nom de fichier)
-        b = item['uuid'].encode('UTF-8')
-        length = len(b)
-        length_b = length.to_bytes(1, byteorder='little')
-        stream.write(length_b)
-        stream.write(b)
-        stream.write(bytezero*(64-length))
-        
-        # titre
-        b = item['title'].encode('UTF-8')
-        length = len(b)
-        length_b = length.to_bytes(1, byteorder='little')
-        stream.write(length_b)
-        stream.write(b)
-        stream.write(bytezero*(66-length))
+def patch_merlin_playlist(filepath, items, chunk_records=512):
+    # rewrite only the records that differ from the playlist already on disk
+    # items can be any iterable, returns the number of records written
+    if not os.path.exists(filepath):
+        with open(filepath, 'wb') as file:
+            return write_merlin_playlist(file, items, chunk_records)
     
+    written = 0
+    record = bytearray(RECORD_SIZE)
+    with open(filepath, 'r+b') as file:
+        old_data = file.read()
+        if len(old_data) % RECORD_SIZE:
+            old_data = b''
+        # contiguous runs of changed records are written with a single call
+        run_start = None
+        run = bytearray()
+        offset = 0
+        for item in items:
+            pack_merlin_record(record, 0, item)
+            changed = old_data[offset:offset+RECORD_SIZE] != record
+            if changed:
+                if run_start is None:
+                    run_start = offset
+                run += record
+            if run and (not changed or len(run) >= RECORD_SIZE*chunk_records):
+                file.seek(run_start)
+                file.write(run)
+                written += len(run) // RECORD_SIZE
+                run_start = None if not changed else run_start + len(run)
+                run = bytearray()
+            offset += RECORD_SIZE
+        if run:
+            file.seek(run_start)
+            file.write(run)
+            written += len(run) // RECORD_SIZE
+        if len(old_data) != offset:
+            file.truncate(offset)
+        file.flush()
+        os.fsync(file.fileno())
+    return written
+
+
+class PlaylistRecord:
+    # one record of a PlaylistView, fields are decoded when accessed
+
+    __slots__ = ('buffer', 'offset')
+
+    int_fields = {key: (struct.Struct('<H'), 2*i) for i, key in enumerate(PLAYLIST_FIELDS[:6])}
+    int_fields['limit_time'] = (struct.Struct('<I'), 12)
+    int_fields['add_time'] = (struct.Struct('<I'), 16)
+    str_fields = {'uuid': 20, 'title': 85}
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def __getitem__(self, key):
+        if key in PlaylistRecord.str_fields:
+            start = self.offset + PlaylistRecord.str_fields[key]
+            length = self.buffer[start]
+            return bytes(self.buffer[start+1:start+1+length]).decode('UTF-8')
+        fmt, field_offset = PlaylistRecord.int_fields[key]
+        return fmt.unpack_from(self.buffer, self.offset+field_offset)[0]
+
+    def keys(self):
+        return PLAYLIST_FIELDS + ('uuid', 'title')
+
+    def to_dict(self):
+        return decode_merlin_record(playlist_record.unpack_from(self.buffer, self.offset))
+
+    def __repr__(self):
+        return f"PlaylistRecord({self.to_dict()!r})"
+
+
+class PlaylistView:
+    # read-only, memory-mapped access to a playlist.bin file
+    # records are decoded lazily; only an id->index map is built on opening
+
+    id_parent = struct.Struct('<2H')
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size % RECORD_SIZE:
+            self.file.close()
+            raise Exception("wrong file format")
+        if size:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b''
+        self.nb_records = size // RECORD_SIZE
+        self.id_index = {}
+        self.parent_index = None
+        unpack_from = PlaylistView.id_parent.unpack_from
+        for index in range(self.nb_records):
+            self.id_index[unpack_from(self.buffer, index*RECORD_SIZE)[0]] = index
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.nb_records
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.nb_records
+        if not 0 <= index < self.nb_records:
+            raise IndexError("playlist record index out of range")
+        return PlaylistRecord(self.buffer, index*RECORD_SIZE)
+
+    def __iter__(self):
+        for index in range(self.nb_records):
+            yield PlaylistRecord(self.buffer, index*RECORD_SIZE)
+
+    def __contains__(self, id):
+        return id in self.id_index
+
+    def ids(self):
+        return self.id_index.keys()
+
+    def by_id(self, id):
+        return self[self.id_index[id]]
+
+    def children(self, parent_id):
+        if self.parent_index is None:
+            self.parent_index = dict()
+            unpack_from = PlaylistView.id_parent.unpack_from
+            for index in range(self.nb_records):
+                parent = unpack_from(self.buffer, index*RECORD_SIZE)[1]
+                self.parent_index.setdefault(parent, []).append(index)
+        records = [self[index] for index in self.parent_index.get(parent_id, [])]
+        records.sort(key=lambda record: record['order'])
+        return records
+
+
+def load_merlin_playlist(filepath):
+    # items of a playlist.bin file or of a zip archive, with the paths of their image and sound
+    if filepath[-3:] == "zip":
+        with zipfile.ZipFile(filepath, 'r') as z:
+            with z.open("playlist.bin", "r") as file:
+                items = read_merlin_playlist(file)
+        for item in items:
+            item['imagepath'] = filepath
+            if item['type'] in [4, 36]:
+                item['soundpath'] = filepath
+            else:
+                item['soundpath'] = ''
+    else:
+        dirname = os.path.dirname(filepath)
+        with open(filepath, "rb") as file:
+            items = read_merlin_playlist(file)
+        for item in items:
+            if item['type'] == 1: # root
+                item['imagepath'] = ''
+            else:
+                item['imagepath'] = os.path.join(dirname, item['uuid'] + '.jpg')
+            if item['type'] in [4, 36]:
+                item['soundpath'] = os.path.join(dirname, item['uuid'] + '.mp3')
+            else:
+                item['soundpath'] = ''
+    return items
+
+
+def find_common_prefix_and_suffix(basenames):
+    if len(basenames) < 2:
+        return None, None
+    common_prefix = None
+    common_suffix = None
+    for basename in basenames:
+        if common_prefix is None:
+            common_prefix = basename
+            common_suffix = basename[::-1]
+        else:
+            common_prefix = os.path.commonprefix([common_prefix, basename])
+            common_suffix = os.path.commonprefix([common_suffix, basename[::-1]])
+    return common_prefix, common_suffix[::-1]
+
+
+def shorten_filename(filename, trim_prefix, trim_suffix):
+    if trim_prefix is None and trim_suffix is None:
+        filename = os.path.splitext(os.path.basename(filename))[0]
+    else:
+        if trim_prefix is not None and filename.startswith(trim_prefix):
+            filename = filename[len(trim_prefix):]
+        if trim_suffix is not None and filename.endswith(trim_suffix):
+            filename = filename[:-len(trim_suffix)]
+    fb = filename.encode('UTF-8')
+    if len(fb) > 60:
+        fb = fb[:60]
+    return fb.decode('UTF-8')
+
+
 def format_item(item):
     for key in ("fav_order", "type", "limit_time", "add_time", "nb_children"):
         if type(item[key]) is not int:
@@ -147,53 +301,334 @@ def format_item(item):
        
     
 
+class SourceArchives:
+    # keeps one open ZipFile per source archive during an export
+    
+    def __init__(self):
+        self.archives = dict()
+        self.lock = threading.Lock()
+    
+    def get(self, path):
+        with self.lock:
+            if path not in self.archives:
+                try:
+                    self.archives[path] = zipfile.ZipFile(path, "r")
+                except (IOError, zipfile.BadZipFile):
+                    self.archives[path] = None
+            return self.archives[path]
+    
+    def close(self):
+        for zin in self.archives.values():
+            if zin:
+                zin.close()
+        self.archives = dict()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+# the raw copy of members writes to the ZipFile through its private attributes,
+# it is only used when they are all there, else the members are streamed
+RAW_COPY_MODULE_ATTRS = ('sizeFileHeader', 'structFileHeader', 'stringFileHeader',
+                         '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+RAW_COPY_ZIPFILE_ATTRS = ('_lock', '_writing', '_seekable', '_didModify', '_writecheck', 'start_dir', 'fp')
+RAW_COPY_SUPPORTED = sys.version_info >= (3, 6) and all(hasattr(zipfile, a) for a in RAW_COPY_MODULE_ATTRS)
+
+
+def can_copy_raw(zin, src_info, zfile):
+    if not RAW_COPY_SUPPORTED or zin.fp is None:
+        return False
+    if not all(hasattr(z, a) for z in (zin, zfile) for a in RAW_COPY_ZIPFILE_ATTRS) or zfile._writing:
+        return False
+    # encrypted members may take their check byte from the time field when they have a data descriptor,
+    # they are decrypted and written again instead
+    return not src_info.flag_bits & 0x01
+
+
+def copy_raw_member(zin, src_info, zfile, filename):
+    # copy the stored/deflated bytes of a member and its CRC to zfile, without decompressing them
+    zinfo = zipfile.ZipInfo(filename, src_info.date_time)
+    zinfo.compress_type = src_info.compress_type
+    zinfo.CRC = src_info.CRC
+    zinfo.compress_size = src_info.compress_size
+    zinfo.file_size = src_info.file_size
+    zinfo.flag_bits = src_info.flag_bits & ~0x08 # sizes are known, no data descriptor
+    zinfo.external_attr = src_info.external_attr
+    zinfo.create_system = src_info.create_system
+    zinfo.extract_version = max(zinfo.extract_version, src_info.extract_version)
+    
+    with zin._lock:
+        zin.fp.seek(src_info.header_offset)
+        header = zin.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"bad local header for '{src_info.filename}'")
+        header = struct.unpack(zipfile.structFileHeader, header)
+        zin.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        
+        with zfile._lock:
+            if zfile._writing:
+                raise ValueError("cannot copy a member while another one is being written")
+            if zfile._seekable:
+                zfile.fp.seek(zfile.start_dir)
+            zinfo.header_offset = zfile.fp.tell()
+            zfile._writecheck(zinfo)
+            zfile._didModify = True
+            zfile.fp.write(zinfo.FileHeader())
+            remaining = src_info.compress_size
+            while remaining:
+                chunk = zin.fp.read(min(remaining, 1024*1024))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"truncated member '{src_info.filename}'")
+                zfile.fp.write(chunk)
+                remaining -= len(chunk)
+            zfile.start_dir = zfile.fp.tell()
+            zfile.filelist.append(zinfo)
+            zfile.NameToInfo[zinfo.filename] = zinfo
+
+
+def copy_from_archive(sources, archivepath, filename, zfile):
+    zin = sources.get(archivepath)
+    if zin is None:
+        return False
+    try:
+        src_info = zin.getinfo(filename)
+    except KeyError:
+        return False
+    if can_copy_raw(zin, src_info, zfile):
+        try:
+            copy_raw_member(zin, src_info, zfile, filename)
+        except (IOError, zipfile.BadZipFile):
+            return False
+    else:
+        with zin.open(src_info, pwd=info) as fin, zfile.open(filename, "w") as fout:
+            shutil.copyfileobj(fin, fout, 1024*1024)
+    return True
+
+
+def render_image(imagepath):
+    # 128x128 baseline JPEG, as expected by the Merlin
+    # Pillow is imported here, the command line tools only load it when they need it
+    from PIL import Image
+    with Image.open(imagepath) as image:
+        image_icon = image.resize((128,128), Image.ANTIALIAS)
+        stream = io.BytesIO()
+        image_icon.save(stream, "JPEG", mode='RGB', optimize=False, progressive=False)
+    return stream.getvalue()
+
+
 def export_merlin_to_zip(items, zfile):
-    files_not_found = []        
-    for item in items:
-        imagepath = item['imagepath']
-        if imagepath:
+    files_not_found = []
+    # names already in the output archive, media are exported once per uuid
+    written = set(zfile.namelist())
+    # items can be a generator: playlist.bin is encoded during the single pass over them,
+    # and stored at the end as only one member of the archive can be written at a time
+    playlist = io.BytesIO()
+    record = bytearray(RECORD_SIZE)
+    with SourceArchives() as sources:
+        for item in items:
+            pack_merlin_record(record, 0, item)
+            playlist.write(record)
+            imagepath = item['imagepath']
             filename = item['uuid'] + '.jpg'
-            outfilezippath = zipfile.Path(zfile, at=filename)
-            if not outfilezippath.exists():
+            if imagepath and filename not in written:
+                written.add(filename)
                 if imagepath[-4:] == '.jpg':
                     if os.path.exists(imagepath):
-                        with Image.open(imagepath) as image:
-                            image_icon = image.resize((128,128), Image.ANTIALIAS)
-                            with zfile.open(filename, "w") as fout:
-                                image_icon.save(fout, "JPEG", mode='RGB', optimize=False, progressive=False)
+                        with zfile.open(filename, "w") as fout:
+                            fout.write(render_image(imagepath))
                     else:
                         files_not_found.append(imagepath)
-                else:
-                    try:
-                        with zipfile.ZipFile(imagepath, "r") as zin:
-                            with zfile.open(filename, "w") as fout:
-                                fout.write(zin.read(filename, pwd=info))
-                    except IOError:
-                        files_not_found.append(item['uuid'] + '.jpg')
-
-        soundpath = item['soundpath']
-        if soundpath:
+                elif not copy_from_archive(sources, imagepath, filename, zfile):
+                    files_not_found.append(filename)
+
+            soundpath = item['soundpath']
             filename = item['uuid'] + '.mp3'
-            outfilezippath = zipfile.Path(zfile, at=filename)
-            if not outfilezippath.exists():
+            if soundpath and filename not in written:
+                written.add(filename)
                 if soundpath[-4:] == '.mp3':
                     if os.path.exists(soundpath):
                         zfile.write(soundpath, filename)
                     else:
-                        file_not_found.append(soundpath)
-                else:
-                    try:
-                        with zipfile.ZipFile(soundpath, "r") as zin:
-                            with zfile.open(filename, "w") as fout:
-                                fout.write(zin.read(filename, pwd=info))
-                    except IOError:
-                        files_not_found.append(filename)
+                        files_not_found.append(soundpath)
+                elif not copy_from_archive(sources, soundpath, filename, zfile):
+                    files_not_found.append(filename)
     with zfile.open("playlist.bin", "w") as fout:
-        write_merlin_playlist(fout, items)
+        fout.write(playlist.getbuffer())
     
     return files_not_found
         
 
+def media_sources(items):
+    # {filename: source path} for the image and sound of every item, once per uuid
+    sources = dict()
+    for item in items:
+        if item['imagepath']:
+            sources.setdefault(item['uuid'] + '.jpg', item['imagepath'])
+        if item['soundpath']:
+            sources.setdefault(item['uuid'] + '.mp3', item['soundpath'])
+    return sources
+
+
+def write_file_atomic(filepath, stream, mtime=None):
+    temppath = filepath + '.part'
+    try:
+        with open(temppath, 'wb') as fout:
+            shutil.copyfileobj(stream, fout, 1024*1024)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temppath, filepath)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+    if mtime:
+        os.utime(filepath, (mtime, mtime))
+
+
+def file_crc(filepath):
+    crc = 0
+    with open(filepath, 'rb') as file:
+        while (chunk := file.read(1024*1024)):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_up_to_date(filepath, size, mtime, check_hash=None):
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != size:
+        return False
+    if check_hash:
+        return check_hash()
+    # FAT file systems only store modification times with a 2 seconds resolution
+    return abs(stat.st_mtime - mtime) <= 2
+
+
+def is_same_file(path1, path2):
+    try:
+        return os.path.samefile(path1, path2)
+    except OSError:
+        return False
+
+
+def sync_media_file(sources, filename, sourcepath, dirpath, check_hash):
+    # copy a single image or sound to the card if it is missing or has changed
+    # returns 'copied', 'skipped' or 'missing'
+    destpath = os.path.join(dirpath, filename)
+    extension = filename[-4:]
+    if sourcepath[-4:] != extension:
+        zin = sources.get(sourcepath)
+        if zin is None:
+            return 'missing'
+        try:
+            zinfo = zin.getinfo(filename)
+        except KeyError:
+            return 'missing'
+        mtime = mktime(zinfo.date_time + (0, 0, -1))
+        crc_check = (lambda: file_crc(destpath) == zinfo.CRC) if check_hash else None
+        if is_up_to_date(destpath, zinfo.file_size, mtime, crc_check):
+            return 'skipped'
+        with zin.open(zinfo, pwd=info) as fin:
+            write_file_atomic(destpath, fin, mtime)
+    elif not os.path.exists(sourcepath):
+        return 'missing'
+    elif is_same_file(sourcepath, destpath):
+        return 'skipped'
+    elif extension == '.jpg':
+        # images are resized for the card, their copy gets the modification time of the source:
+        # they are only rendered again when the source has changed, or to compare their content with check_hash
+        mtime = os.stat(sourcepath).st_mtime
+        if not check_hash:
+            try:
+                if abs(os.stat(destpath).st_mtime - mtime) <= 2:
+                    return 'skipped'
+            except FileNotFoundError:
+                pass
+        data = render_image(sourcepath)
+        if os.path.exists(destpath) and os.path.getsize(destpath) == len(data):
+            with open(destpath, 'rb') as file:
+                if file.read() == data:
+                    os.utime(destpath, (mtime, mtime))
+                    return 'skipped'
+        write_file_atomic(destpath, io.BytesIO(data), mtime)
+    else:
+        stat = os.stat(sourcepath)
+        crc_check = (lambda: file_crc(destpath) == file_crc(sourcepath)) if check_hash else None
+        if is_up_to_date(destpath, stat.st_size, stat.st_mtime, crc_check):
+            return 'skipped'
+        with open(sourcepath, 'rb') as fin:
+            write_file_atomic(destpath, fin, stat.st_mtime)
+    return 'copied'
+
+
+def sync_merlin_to_directory(items, dirpath, delete_orphans=False, check_hash=False, max_workers=4,
+                             progress=None, cancel=None):
+    # copy to a card folder only the missing or changed media, then write playlist.bin
+    # progress(done, total) is called as the files are synced, setting the cancel event stops the sync
+    # playlist.bin is only written when every file is on the card, so that the card never refers to missing files
+    from concurrent.futures import ThreadPoolExecutor # not needed by the quick command line tools
+    report = {'copied': [], 'skipped': 0, 'files_not_found': [], 'failed': [], 'orphans': [], 'deleted': [],
+              'playlist_written': False, 'cancelled': False}
+    to_sync = media_sources(items)
+    # orphans are only deleted from a folder that already holds a Merlin playlist
+    is_card = os.path.exists(os.path.join(dirpath, 'playlist.bin'))
+    with SourceArchives() as sources, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(sync_media_file, sources, filename, sourcepath, dirpath, check_hash): filename
+                   for filename, sourcepath in to_sync.items()}
+        for done, (future, filename) in enumerate(futures.items(), 1):
+            if cancel is not None and cancel.is_set():
+                for future in futures:
+                    future.cancel()
+                report['cancelled'] = True
+                break
+            try:
+                status = future.result()
+            except Exception as e:
+                # a file that cannot be read or written does not stop the others
+                status = 'failed'
+                report['failed'].append((filename, str(e)))
+            if status == 'copied':
+                report['copied'].append(filename)
+            elif status == 'skipped':
+                report['skipped'] += 1
+            elif status == 'missing':
+                report['files_not_found'].append(filename)
+            if progress:
+                progress(done, len(futures))
+    
+    for entry in os.scandir(dirpath):
+        if entry.is_file() and entry.name[-4:] in ('.mp3', '.jpg') and entry.name not in to_sync:
+            report['orphans'].append(entry.name)
+    if report['cancelled'] or report['files_not_found'] or report['failed']:
+        return report
+    
+    # the playlist is written last, the orphans are deleted once it no longer refers to them
+    write_file_atomic(os.path.join(dirpath, 'playlist.bin'), io.BytesIO(encode_merlin_playlist(items)))
+    report['playlist_written'] = True
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    if delete_orphans and is_card:
+        for name in report['orphans']:
+            try:
+                os.remove(os.path.join(dirpath, name))
+            except OSError as e:
+                report['failed'].append((name, str(e)))
+                continue
+            report['deleted'].append(name)
+    return report
+
+
 def IsImageProgressive(stream):
     #with open(filename, "rb") as stream:
     while True:
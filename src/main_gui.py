@@ -9,30 +9,42 @@ import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog
 from PIL import Image
 from PIL.ImageTk import PhotoImage
-import os.path, zipfile
+import os.path, zipfile, sys, json, threading
+from functools import partial
+from time import perf_counter
 
 from io_utils import *
 from treeviews import MerlinMainTree, MerlinFavTree
+from thumbnails import ThumbnailCache, decode_thumbnails
+from media_index import MediaIndex, media_entries
+from session_journal import SessionJournal
+from session_snapshot import SessionSnapshot, is_session_snapshot, decode_session
+from validator import validate
 from gui_actions import *
-try:
-    from audio import AudioWidget
-    enable_audio = True
-except ImportError as error:
-    enable_audio = False
+from audio import AudioWidget, audio_available
+enable_audio = audio_available()
+
+# MERLINATOR_STARTUP_TIMES=1 prints the duration of each startup phase
+STARTUP_TIMES = bool(os.environ.get('MERLINATOR_STARTUP_TIMES'))
 
 class MerlinGUI(GUIActions):
     
-    def __init__(self):
+    def __init__(self, start_time=None):
+        self.startup_marks = [('start', start_time or perf_counter())]
+        self.mark_startup('imports')
         # create root window
         tk.Tk.__init__(self)
         self.title('Merlinator')
         # self.iconbitmap("../res/merlinator_64px.ico")
-        self.load_image()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         self.sessionpath = ''
-        self.sessionfile = None
+        # edits are journaled to the session file as they are made
+        self.journal = None
         self.thumbnails = {}
+        # durations, formats and sizes of the media, filled in the background
+        self.media_index = MediaIndex()
+        self.thumbnail_cache = ThumbnailCache(media_index=self.media_index)
         self.moveitem = tk.StringVar()
         self.src_widget = None
         self.save_cursor = self['cursor'] or ''
@@ -65,6 +77,8 @@ class MerlinGUI(GUIActions):
         file_menu.add_command(label="Importer playlist/archive (Ctrl-i)", underline=0, command=self.import_playlist)
         file_menu.add_command(label="Exporter playlist (Ctrl-e)", underline=0, command=self.export_playlist)
         file_menu.add_command(label="Exporter archive (Ctrl-x)", underline=1, command=self.export_all_to_zip)
+        file_menu.add_command(label="Synchroniser carte SD (Ctrl-y)", underline=0, command=self.sync_to_card)
+        file_menu.add_command(label="Vérifier la playlist", underline=0, command=self.validate_playlist)
         file_menu.add_separator()
         file_menu.add_command(label="Quitter", underline=0, command=self.quit)
         
@@ -174,6 +188,48 @@ class MerlinGUI(GUIActions):
         self.bind("<Control-i>", lambda event:self.import_playlist())
         self.bind("<Control-e>", lambda event:self.export_playlist())
         self.bind("<Control-x>", lambda event:self.export_all_to_zip())
+        self.bind("<Control-y>", lambda event:self.sync_to_card())
+        
+        self.mark_startup('widgets')
+        # the rest is loaded once the window is shown
+        if self.winfo_ismapped():
+            self.first_paint()
+        else:
+            self.bind('<Expose>', self.first_paint)
+        
+    def first_paint(self, event=None):
+        # the window is mapped: draw the pending widgets now, so that the mark is taken once they are on screen
+        if event is not None and event.widget is not self:
+            return
+        self.unbind('<Expose>')
+        self.update_idletasks()
+        self.mark_startup('first paint')
+        self.after_idle(self.after_first_paint)
+        
+    def after_first_paint(self):
+        self.load_image()
+        self.mark_startup('icon')
+        if self.enable_audio:
+            self.audio_widget.start_backend(callback=self.audio_backend_ready)
+        else:
+            self.report_startup()
+    
+    def audio_backend_ready(self):
+        self.mark_startup('audio backend')
+        if self.audio_widget.backend_error:
+            print(f"Audio désactivé: {self.audio_widget.backend_error}", file=sys.stderr)
+        self.report_startup()
+        
+    def mark_startup(self, phase):
+        self.startup_marks.append((phase, perf_counter()))
+    
+    def report_startup(self):
+        if not STARTUP_TIMES:
+            return
+        start = previous = self.startup_marks[0][1]
+        for phase, t in self.startup_marks[1:]:
+            print(f"{phase:15} {(t-previous)*1000:8.1f} ms  (total {(t-start)*1000:8.1f} ms)", file=sys.stderr)
+            previous = t
 
 
         
@@ -211,50 +267,92 @@ class MerlinGUI(GUIActions):
         
 
     def populate_trees(self, items, overwrite=True):
-        self.main_tree.populate(items, self.thumbnails, overwrite)
+        # thumbnails are loaded by the main tree, as the items get inserted
+        if overwrite:
+            self.thumbnails = {}
+        report = self.main_tree.populate(items, overwrite)
         self.fav_tree.populate(self.main_tree, overwrite)
+        if self.journal:
+            # imported items are not journaled, save a new snapshot
+            try:
+                self.journal.compact()
+            except IOError:
+                tk.messagebox.showwarning("Erreur", "Fichier de session non accessible")
+        if report and report['merged']:
+            self.show_merge_report(report)
+        self.index_media()
+        return report
+    
+    def index_media(self):
+        self.media_index.start_fill(media_entries(self.main_tree.iter_items()))
+    
+    
+    def show_merge_report(self, report):
+        message = f"{len(report['matched'])} éléments communs, {len(report['added'])} éléments ajoutés."
+        if report['conflicting']:
+            titles = [self.main_tree.item(iid, 'text')[3:] for iid in report['conflicting']]
+            message += f"\n{len(titles)} éléments ajoutés ont le même titre ou le même fichier qu'un élément existant:\n" + \
+                       "\n".join([f"- '{t}'" for t in titles[:20]])
+            if len(titles) > 20:
+                message += "\n..."
+        tk.messagebox.showinfo("Fusion des playlists", message)
         
 
     def load_thumbnails(self, items, overwrite=True):
         if overwrite:
             self.thumbnails = {}
+        imagepaths = dict()
+        archives = dict()
         for item in items:
             imagepath = item['imagepath']
-            if item['uuid'] in self.thumbnails:
+            if item['uuid'] in self.thumbnails or item['uuid'] in imagepaths:
                 continue
-            if os.path.exists(imagepath):
-                with open(imagepath, "rb") as imagestream:
-                    if IsImageProgressive(imagestream):
-                        tk.messagebox.showwarning(title="Problème de format", message=f"Le format de l'image '{imagepath}' est JPEG 'progressive'. Ce format n'est pas pris en charge par toutes les Merlin.")
-                        self.thumbnails[item['uuid']] = ''
-                        continue
-                with Image.open(imagepath) as image:
-                    image_small = image.resize((40, 40), Image.ANTIALIAS)
-                    self.thumbnails[item['uuid']] = PhotoImage(image_small)
+            if imagepath[-4:] == '.zip':
+                archives.setdefault(imagepath, []).append(item)
+            elif os.path.exists(imagepath):
+                imagepaths[item['uuid']] = imagepath
             else:
                 self.thumbnails[item['uuid']] = ''
+        cache = self.thumbnail_cache
+        images = decode_thumbnails({uuid: partial(cache.thumbnail_from_file, uuid, imagepath) \
+                                    for uuid, imagepath in imagepaths.items()})
+        self.set_thumbnails(images, imagepaths)
+        for archivepath, archive_items in archives.items():
+            try:
+                with zipfile.ZipFile(archivepath, 'r') as zfile:
+                    self.load_thumbnails_from_zip(archive_items, zfile, overwrite=False)
+            except (IOError, zipfile.BadZipFile):
+                for item in archive_items:
+                    self.thumbnails[item['uuid']] = ''
+        cache.prune()
                 
     
     def load_thumbnails_from_zip(self, items, zfile, overwrite=True):
         if overwrite:
             self.thumbnails = {}
+        zinfos = dict()
         for item in items:
-            if item['uuid'] in self.thumbnails:
+            if item['uuid'] in self.thumbnails or item['uuid'] in zinfos:
                 continue
             filename = item['uuid'] + '.jpg'
-            zippath = zipfile.Path(zfile, at=filename)
-            if zippath.exists():
-                with zfile.open(filename, 'r', pwd=info) as imagestream:
-                    if IsImageProgressive(imagestream):
-                        tk.messagebox.showwarning(title="Problème de format", message=f"Le format de l'image '{filename}' est JPEG 'progressive'. Ce format n'est pas pris en charge par toutes les Merlin.")
-                        self.thumbnails[item['uuid']] = ''
-                        continue
-                with zfile.open(filename, 'r', pwd=info) as imagefile:
-                    with Image.open(imagefile) as image:
-                        image_small = image.resize((40, 40), Image.ANTIALIAS)
-                        self.thumbnails[item['uuid']] = PhotoImage(image_small)
+            try:
+                zinfos[item['uuid']] = zfile.getinfo(filename)
+            except KeyError:
+                self.thumbnails[item['uuid']] = ''
+        cache = self.thumbnail_cache
+        images = decode_thumbnails({uuid: partial(cache.thumbnail_from_zip, uuid, zfile, zinfo) \
+                                    for uuid, zinfo in zinfos.items()})
+        self.set_thumbnails(images, {uuid: zinfo.filename for uuid, zinfo in zinfos.items()})
+        cache.prune()
+        
+    
+    def set_thumbnails(self, images, names):
+        for uuid, image_small in images.items():
+            if image_small is None:
+                tk.messagebox.showwarning(title="Problème de format", message=f"Le format de l'image '{names[uuid]}' est JPEG 'progressive'. Ce format n'est pas pris en charge par toutes les Merlin.")
+                self.thumbnails[uuid] = ''
             else:
-                self.thumbnails[item['uuid']] = ''    
+                self.thumbnails[uuid] = PhotoImage(image_small)
                 
     def load_image(self):
         filename = "merlinator_64px.ico"
@@ -285,32 +383,7 @@ class MerlinGUI(GUIActions):
         if overwrite:
             self.playlistpath = filepath
         try: 
-            if filepath[-3:] == "bin":
-                dirname = os.path.dirname(filepath)
-                with open(filepath, "rb") as file:
-                    items = read_merlin_playlist(file)
-                    for item in items:
-                        if item['type'] == 1: # root
-                            item['imagepath'] = ''
-                        else:
-                            item['imagepath'] = os.path.join(dirname, item['uuid'] + '.jpg')
-                        if item['type'] in [4, 36]:
-                            soundpath = os.path.join(dirname, item['uuid'] + '.mp3')
-                            item['soundpath'] = soundpath
-                        else:
-                            item['soundpath'] = ''
-                    self.load_thumbnails(items, overwrite)
-            elif filepath[-3:] == "zip":
-                with zipfile.ZipFile(filepath, 'r') as z:
-                    with z.open("playlist.bin", "r") as file:
-                        items = read_merlin_playlist(file)
-                    for item in items:
-                        item['imagepath'] = filepath
-                        if item['type'] in [4, 36]:
-                            item['soundpath'] = filepath
-                        else:
-                            item['soundpath'] = ''
-                    self.load_thumbnails_from_zip(items, z, overwrite)
+            items = load_merlin_playlist(filepath)
             self.populate_trees(items, overwrite)
             self.buttonAddMenu['state'] = 'normal'
             self.buttonAddSound['state'] = 'normal'
@@ -323,10 +396,14 @@ class MerlinGUI(GUIActions):
         if not t.get_children(''):
             return
         filepath = filedialog.asksaveasfilename(initialfile="playlist.bin", initialdir=self.playlistpath, filetypes=[('binaire', '*.bin')])
+        if not filepath:
+            return
+        # the playlist is streamed twice, to validate it and to write it
+        if not self.check_playlist(t.iter_items()):
+            return
         try:
-            with open(filepath, "wb") as file:
-                items = t.make_item_list()
-                write_merlin_playlist(file, items)
+            # only the records that changed are rewritten on the card
+            patch_merlin_playlist(filepath, t.iter_items())
         except IOError:
             tk.messagebox.showwarning("Erreur", "Fichier non accessible")     
    
@@ -336,68 +413,188 @@ class MerlinGUI(GUIActions):
         if not t.get_children(''):
             return
         filepath = filedialog.asksaveasfilename(initialfile="merlin.zip", filetypes=[('archive zip', '*.zip')])
+        if not filepath:
+            return
+        if not self.check_playlist(t.iter_items()):
+            return
         try:
             with zipfile.ZipFile(filepath, 'w') as zfile:
-                items = self.main_tree.make_item_list()
-                files_not_found = export_merlin_to_zip(items, zfile)
+                files_not_found = export_merlin_to_zip(t.iter_items(), zfile)
             if files_not_found:
                 message = "Les fichiers suivants n'ont pas été trouvés:\n" + "\n".join([f"- '{f}'" for f in files_not_found])
                 tk.messagebox.showwarning("Fichiers non trouvés", message)
         except IOError:
             tk.messagebox.showwarning("Erreur", "Fichier non accessible")
         
+    def sync_to_card(self):
+        t = self.main_tree
+        if not t.get_children(''):
+            return
+        dirpath = filedialog.askdirectory(title="Dossier racine de la carte SD", mustexist=True)
+        if not dirpath:
+            return
+        delete_orphans = tk.messagebox.askyesnocancel("Fichiers orphelins", "Supprimer de la carte les sons et images qui ne sont plus dans la playlist?")
+        if delete_orphans is None:
+            return
+        items = t.make_item_list()
+        if not self.check_playlist(items):
+            return
+        # the files are copied by a worker thread, the dialog shows its progress
+        cancel = threading.Event()
+        state = {'done': 0}
+        def run():
+            try:
+                state['report'] = sync_merlin_to_directory(items, dirpath, delete_orphans, progress=progress, cancel=cancel)
+            except Exception as e:
+                state['error'] = e
+        def progress(done, total):
+            state['done'] = done
+        dialog = ProgressDialog(self, "Synchronisation de la carte", len(media_sources(items)), cancel.set)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.poll_sync(thread, dialog, state)
+        
+    def poll_sync(self, thread, dialog, state):
+        if thread.is_alive():
+            dialog.set_progress(state['done'])
+            self.after(100, self.poll_sync, thread, dialog, state)
+            return
+        dialog.destroy()
+        if 'error' in state:
+            tk.messagebox.showwarning("Erreur", f"Fichier non accessible: {state['error']}")
+            return
+        report = state['report']
+        if report['cancelled']:
+            tk.messagebox.showinfo("Synchronisation annulée", "La playlist de la carte n'a pas été modifiée.")
+            return
+        lines = [f"- '{f}': fichier non trouvé" for f in report['files_not_found']]
+        lines += [f"- '{f}': {error}" for f, error in report['failed']]
+        if lines:
+            message = "Les fichiers suivants n'ont pas pu être copiés:\n" + "\n".join(lines)
+            if not report['playlist_written']:
+                message += "\n\nLa playlist de la carte n'a pas été modifiée."
+            tk.messagebox.showwarning("Synchronisation incomplète", message)
+        
+    def run_validation(self, items):
+        self.config(cursor="watch")
+        self.update()
+        try:
+            return validate(items, media_index=self.media_index)
+        finally:
+            self.config(cursor=self.save_cursor)
+    
+    def format_issues(self, issues, limit=15):
+        lines = [f"- '{i['title']}': {i['message']}" if i['id'] is not None else f"- {i['message']}" for i in issues[:limit]]
+        if len(issues) > limit:
+            lines.append(f"... et {len(issues)-limit} autres")
+        return "\n".join(lines)
+    
+    def check_playlist(self, items):
+        # validation before an export, returns False if there are errors and the user cancels
+        report = self.run_validation(items)
+        errors = [i for i in report['issues'] if i['level'] == 'error']
+        if not errors:
+            return True
+        message = f"La playlist contient {len(errors)} erreur(s):\n" + self.format_issues(errors) + "\n\nExporter quand même ?"
+        return tk.messagebox.askyesno("Playlist non valide", message)
+    
+    def validate_playlist(self):
+        t = self.main_tree
+        if not t.get_children(''):
+            return
+        report = self.run_validation(t.iter_items())
+        if not report['issues']:
+            tk.messagebox.showinfo("Vérification", f"Aucun problème détecté ({report['items']} éléments).")
+            return
+        message = f"{report['errors']} erreur(s), {report['warnings']} avertissement(s):\n" + self.format_issues(report['issues']) \
+                  + "\n\nEnregistrer le rapport complet ?"
+        if not tk.messagebox.askyesno("Vérification", message):
+            return
+        filepath = filedialog.asksaveasfilename(initialfile="rapport.json", filetypes=[('json', '*.json')])
+        if not filepath:
+            return
+        try:
+            with open(filepath, 'w', encoding='UTF-8') as file:
+                json.dump(report, file, indent=2, ensure_ascii=False)
+        except IOError:
+            tk.messagebox.showwarning("Erreur", "Fichier non accessible")
+    
+    def close_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        
     def new_session(self):
+        self.close_journal()
+        self.sessionpath = ''
         items = MerlinMainTree.defaultItems
-        dir_of_merlinator = os.path.dirname(os.path.realpath(__file__))
-        with zipfile.ZipFile(os.path.join(dir_of_merlinator,'../res/defaultPics.zip'), 'r') as zfile:
-            self.load_thumbnails_from_zip(items, zfile)
         self.populate_trees(items, overwrite=True)
         self.buttonAddMenu['state'] = 'normal'
         self.buttonAddSound['state'] = 'normal'
         self.playlistpath = "."
         
     def save_session(self):
-        if not self.sessionfile:
+        if not self.journal:
             self.saveas_session()
             return
         elif not self.main_tree.get_children(''):
             return
-        if not self.sessionfile.closed:
-            self.sessionfile.close()
-        self.sessionfile = open(self.sessionpath, 'wb')
-        items = self.main_tree.make_item_list()
-        self.sessionfile.write(json.dumps(items, indent=2).encode("utf-8"))
-        self.sessionfile.close()
+        try:
+            # the journal is folded into a new snapshot of the session
+            self.journal.compact()
+        except IOError:
+            tk.messagebox.showwarning("Erreur", "Fichier non accessible") 
     
     def saveas_session(self):
         if not self.main_tree.get_children(''):
             return
-        filepath = filedialog.asksaveasfilename(initialfile="merlinator.json", filetypes=[('fichier json', '*.json')])
+        filepath = filedialog.asksaveasfilename(initialfile="merlinator.json", filetypes=[('fichier json', '*.json'), ('session binaire', '*.mls')])
         if not filepath:
             return
+        # the previous journal is closed first, closing it detaches the model
+        self.close_journal()
+        journal = SessionJournal(filepath)
         try:
-            new_sessionfile = open(filepath, 'w')
-            if self.sessionfile and not self.sessionfile.closed:
-                self.sessionfile.close()
+            journal.attach(self.main_tree.model)
+            journal.compact()
             self.sessionpath = filepath
-            self.sessionfile = new_sessionfile
-            self.save_session()
+            self.journal = journal
         except IOError:
+            journal.close()
             tk.messagebox.showwarning("Erreur", "Fichier non accessible") 
 
             
     def load_session(self):
-        filepath = filedialog.askopenfilename(initialfile="merlinator.json", filetypes=[('fichier json', '*.json')])
+        filepath = filedialog.askopenfilename(initialfile="merlinator.json", filetypes=[('tous types supportés', '*.json;*.mls'), ('fichier json', '*.json'), ('session binaire', '*.mls')])
         if not filepath:
             return
         try:
-            file = open(filepath, 'r')
+            # the session file is the last snapshot, the edits made since are replayed from the journal
+            journal = SessionJournal(filepath)
+            snapshot, records = journal.open()
+            self.close_journal()
             self.sessionpath = filepath
-            self.sessionfile = file
-            items = json.loads(self.sessionfile.read())
-            file.close()
-            self.load_thumbnails(items)
-            self.populate_trees(items)
+            if is_session_snapshot(snapshot) and not records:
+                # binary session: the top-level menus are shown before the rest is decoded
+                session = SessionSnapshot(snapshot)
+                items = session.top_level_items()
+                self.populate_trees(items)
+                self.update()
+                model = self.main_tree.model
+                top_ids = [item['id'] for item in items if item['parent_id'] == 1 and item['type']%32 not in [10, 18]]
+                self.main_tree.add_subtrees(session.subtree_items(), dict(zip(top_ids, model.children(''))))
+                self.fav_tree.populate(self.main_tree, overwrite=True)
+                self.index_media()
+            else:
+                items = decode_session(snapshot)
+                if records:
+                    items, nb_applied = journal.replay(items, records)
+                    if nb_applied < len(records):
+                        # the edits that did not apply are dropped, so that the next ones are replayed
+                        journal.truncate(nb_applied)
+                self.populate_trees(items)
+            journal.attach(self.main_tree.model)
+            self.journal = journal
             self.buttonAddMenu['state'] = 'normal'
             self.buttonAddSound['state'] = 'normal'
         except IOError:
@@ -461,6 +658,7 @@ class MerlinGUI(GUIActions):
                     else:
                         dest = src
                     if new_pos is None:
+                        t.materialize(dest, recursive=False)
                         if t.set(dest, "type") in ['4', '36']: # destination is a file
                             if t.parent(dest)==t.parent(src) and t.index(dest)>=t.index(src):
                                 new_pos = t.index(dest)
@@ -475,15 +673,11 @@ class MerlinGUI(GUIActions):
                     elif t.set(src, "type") in ['4', '36']: # source is a file
                         if src==dest:
                             pass
-                        t.move(src, dest, new_pos)
+                        t.move_node(src, dest, new_pos)
                         t.see(src)
                     elif t.set(src, "type") in ['2', '34']: # source is a directory
-                        iid = t.insert(dest, new_pos, text=t.item(src, "text"),
-                                      values=t.item(src, "values"), image=t.item(src, "image"), 
-                                      tags=t.item(src, "tags"))
-                        t.set_children(iid, *t.get_children(src))
-                        t.delete(src)
-                        t.see(iid)
+                        t.move_node(src, dest, new_pos)
+                        t.see(src)
                     else: # shouldn't happen
                         pass
                     self.sync_buttons_main()
@@ -496,7 +690,7 @@ class MerlinGUI(GUIActions):
                         else:
                             new_pos = 'end'
                     if new_pos is not None:
-                        self.fav_tree.move(src, '', new_pos)
+                        self.fav_tree.move_node(src, '', new_pos)
                     self.sync_buttons_main()
             elif self.src_widget == self.main_tree and t == self.fav_tree:
                 dest_x = event.x+event.widget.winfo_rootx()-t.winfo_rootx()
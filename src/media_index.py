@@ -0,0 +1,259 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import os.path
+import sqlite3
+import threading
+import zipfile
+from time import time
+
+from io_utils import info, file_crc
+from audio_converter import default_cache_dir
+
+
+SOUND_FIELDS = ('duration', 'bitrate', 'channels', 'sample_rate')
+IMAGE_FIELDS = ('width', 'height', 'progressive')
+FIELDS = SOUND_FIELDS + IMAGE_FIELDS + ('crc',)
+
+
+def probe_sound(stream):
+    from mutagen.mp3 import MP3
+    audio = MP3(stream).info
+    return {'duration': audio.length, 'bitrate': audio.bitrate,
+            'channels': audio.channels, 'sample_rate': audio.sample_rate}
+
+
+def probe_image(stream):
+    # only the header is read
+    from PIL import Image
+    with Image.open(stream) as image:
+        width, height = image.size
+        progressive = bool(image.info.get('progressive') or image.info.get('progression'))
+    return {'width': width, 'height': height, 'progressive': progressive}
+
+
+class MediaIndex:
+    # metadata of the sounds and images, keyed by path, mtime and size, or zip member CRC
+    # stored in a SQLite database in the cache directory, shared by the GUI, its threads and the transcoding processes
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir(), 'media.sqlite')
+        self.lock = threading.Lock()
+        self.fill_thread = None
+        self.stop_fill = threading.Event()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS media (key TEXT PRIMARY KEY, '
+                            + ', '.join(FIELDS) + ', used REAL)')
+            self.db.commit()
+        except (OSError, sqlite3.Error):
+            # no index, every lookup probes the file
+            self.db = None
+
+    @staticmethod
+    def file_key(filepath):
+        stat = os.stat(filepath)
+        return f"{os.path.abspath(filepath)}|{stat.st_mtime_ns}|{stat.st_size}"
+
+    @staticmethod
+    def member_key(zippath, zinfo):
+        return f"{os.path.abspath(zippath)}|{zinfo.filename}|{zinfo.CRC:08x}|{zinfo.file_size}"
+
+    def get(self, key):
+        if self.db is None:
+            return None
+        try:
+            with self.lock:
+                row = self.db.execute('SELECT ' + ', '.join(FIELDS) + ' FROM media WHERE key=?', (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        media_info = {field: value for field, value in zip(FIELDS, row) if value is not None}
+        if 'progressive' in media_info:
+            media_info['progressive'] = bool(media_info['progressive'])
+        return media_info
+
+    def put(self, key, media_info):
+        if self.db is None:
+            return
+        # fields already known for this key are kept
+        media_info = dict(self.get(key) or {}, **media_info)
+        values = [media_info.get(field) for field in FIELDS]
+        try:
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO media VALUES (?, ' + ', '.join('?'*len(FIELDS)) + ', ?)',
+                                [key] + values + [time()])
+                self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def get_many(self, keys):
+        # {key: media_info} of the indexed keys, in a few queries
+        res = dict()
+        if self.db is None:
+            return res
+        keys = list(keys)
+        try:
+            with self.lock:
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start+500]
+                    res.update((row[0], {field: value for field, value in zip(FIELDS, row[1:]) if value is not None})
+                               for row in self.db.execute('SELECT key, ' + ', '.join(FIELDS) + ' FROM media WHERE key IN ('
+                                                          + ', '.join('?'*len(chunk)) + ')', chunk))
+        except sqlite3.Error:
+            return res
+        for media_info in res.values():
+            if 'progressive' in media_info:
+                media_info['progressive'] = bool(media_info['progressive'])
+        return res
+
+    def put_many(self, entries):
+        # (key, media_info) stored in a single transaction, replacing the fields already known
+        if self.db is None or not entries:
+            return
+        known = self.get_many(key for key, _ in entries)
+        now = time()
+        rows = [[key] + [dict(known.get(key, {}), **media_info).get(field) for field in FIELDS] + [now]
+                for key, media_info in entries]
+        try:
+            with self.lock:
+                self.db.executemany('INSERT OR REPLACE INTO media VALUES (?, ' + ', '.join('?'*len(FIELDS)) + ', ?)', rows)
+                self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def media_info(self, path, member=None, kind='sound', zfile=None):
+        # metadata of a file, or of the member of a zip archive, probed and stored if not indexed yet
+        # kind is 'sound' or 'image'
+        fields = SOUND_FIELDS if kind == 'sound' else IMAGE_FIELDS
+        probe = probe_sound if kind == 'sound' else probe_image
+        if member is None:
+            key = MediaIndex.file_key(path)
+            media_info = self.get(key)
+            if media_info is None or any(field not in media_info for field in fields):
+                with open(path, 'rb') as stream:
+                    media_info = probe(stream)
+                media_info['crc'] = file_crc(path)
+                self.put(key, media_info)
+            return media_info
+
+        close = zfile is None
+        if close:
+            zfile = zipfile.ZipFile(path, 'r')
+        try:
+            zinfo = zfile.getinfo(member)
+            key = MediaIndex.member_key(path, zinfo)
+            media_info = self.get(key)
+            if media_info is None or any(field not in media_info for field in fields):
+                with zfile.open(zinfo, 'r', pwd=info) as stream:
+                    media_info = probe(stream)
+                media_info['crc'] = zinfo.CRC
+                self.put(key, media_info)
+            return media_info
+        finally:
+            if close:
+                zfile.close()
+
+    def media_infos(self, entries, max_workers=8):
+        # media_info of a list of (path, member, kind, zfile), zfile being the open archive of a member
+        # the entries not indexed yet are probed in parallel, from their headers only (no crc for plain files)
+        # an entry that cannot be read gives its exception instead
+        from concurrent.futures import ThreadPoolExecutor # not needed by the quick command line tools
+        keys = []
+        for path, member, kind, zfile in entries:
+            try:
+                keys.append(MediaIndex.file_key(path) if member is None else MediaIndex.member_key(path, zfile.getinfo(member)))
+            except Exception as e:
+                keys.append(e)
+        known = self.get_many(key for key in keys if not isinstance(key, Exception))
+        res = []
+        todo = []
+        for i, ((path, member, kind, zfile), key) in enumerate(zip(entries, keys)):
+            fields = SOUND_FIELDS if kind == 'sound' else IMAGE_FIELDS
+            media_info = key if isinstance(key, Exception) else known.get(key)
+            if media_info is None or (isinstance(media_info, dict) and any(field not in media_info for field in fields)):
+                todo.append(i)
+            res.append(media_info)
+
+        def probe(i):
+            path, member, kind, zfile = entries[i]
+            probe = probe_sound if kind == 'sound' else probe_image
+            try:
+                if member is None:
+                    with open(path, 'rb') as stream:
+                        return probe(stream)
+                zinfo = zfile.getinfo(member)
+                with zfile.open(zinfo, 'r', pwd=info) as stream:
+                    return dict(probe(stream), crc=zinfo.CRC)
+            except Exception as e:
+                # missing, unreadable or malformed file
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i, media_info in zip(todo, executor.map(probe, todo)):
+                res[i] = media_info
+        self.put_many([(keys[i], res[i]) for i in todo if not isinstance(res[i], Exception)])
+        return res
+
+    def sound_info(self, path, member=None, zfile=None):
+        return self.media_info(path, member, 'sound', zfile)
+
+    def image_info(self, path, member=None, zfile=None):
+        return self.media_info(path, member, 'image', zfile)
+
+
+    def fill(self, entries):
+        # index a list of (path, member, kind), skipping the files that cannot be read
+        archives = dict()
+        try:
+            for path, member, kind in entries:
+                if self.stop_fill.is_set():
+                    break
+                try:
+                    zfile = None
+                    if member is not None:
+                        if path not in archives:
+                            archives[path] = zipfile.ZipFile(path, 'r')
+                        zfile = archives[path]
+                    self.media_info(path, member, kind, zfile)
+                except Exception:
+                    # missing, unreadable or malformed file
+                    continue
+        finally:
+            for zfile in archives.values():
+                zfile.close()
+
+    def start_fill(self, entries):
+        # index in a background thread, a previous filling is stopped
+        self.cancel_fill()
+        self.stop_fill = threading.Event()
+        self.fill_thread = threading.Thread(target=self.fill, args=(list(entries),), daemon=True)
+        self.fill_thread.start()
+
+    def cancel_fill(self):
+        self.stop_fill.set()
+        if self.fill_thread is not None:
+            self.fill_thread.join()
+            self.fill_thread = None
+
+
+def media_entries(items):
+    # (path, member, kind) of the sounds and images of playlist items
+    entries = []
+    for item in items:
+        for key, kind, extension in (('soundpath', 'sound', '.mp3'), ('imagepath', 'image', '.jpg')):
+            path = item.get(key, '')
+            if not path:
+                continue
+            if path[-4:] == '.zip':
+                entries.append((path, item['uuid'] + extension, kind))
+            else:
+                entries.append((path, None, kind))
+    return entries
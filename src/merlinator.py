@@ -4,9 +4,21 @@
 # "MIT License Agreement". Please see the LICENSE file
 # that should have been included as part of this package.
 
-from main_gui import MerlinGUI
+import sys
+import multiprocessing
 
 
-    
-root = MerlinGUI()
-root.mainloop()
\ No newline at end of file
+if __name__ == '__main__':
+    # the transcoding workers are spawned processes on Windows and macOS: they import this
+    # module again, and must not start the GUI or the command line
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # command line use, Tk is not loaded
+        from cli import main
+        sys.exit(main())
+    else:
+        from time import perf_counter
+        start_time = perf_counter()
+        from main_gui import MerlinGUI
+        root = MerlinGUI(start_time)
+        root.mainloop()
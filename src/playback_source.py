@@ -0,0 +1,335 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+from io_utils import info
+from audio_converter import default_cache_dir
+from media_index import MediaIndex
+
+
+# local file header of a zip member, followed by the file name and the extra field
+local_header = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+
+
+class SharedArchive:
+    # an open zip archive, and a raw handle on the same file for the readers of stored members
+    # the handles are closed once the archive has left the pool and its last reader is closed
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.zfile = zipfile.ZipFile(path, 'r')
+        self.raw = open(path, 'rb')
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.evicted = False
+
+    def read_at(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self.raw.fileno(), size, offset)
+        with self.lock:
+            self.raw.seek(offset)
+            return self.raw.read(size)
+
+    def data_offset(self, zinfo):
+        # position of the member data, after its local header
+        header = local_header.unpack(self.read_at(zinfo.header_offset, local_header.size))
+        if header[0] != LOCAL_HEADER_MAGIC:
+            raise zipfile.BadZipFile(f"bad local header for {zinfo.filename}")
+        return zinfo.header_offset + local_header.size + header[10] + header[11]
+
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            close = self.evicted and self.refs == 0
+        if close:
+            self.close()
+
+    def evict(self):
+        with self.lock:
+            self.evicted = True
+            close = self.refs == 0
+        if close:
+            self.close()
+
+    def close(self):
+        self.zfile.close()
+        self.raw.close()
+
+
+class MemberReader(io.RawIOBase):
+    # read-only, seekable view of a stored zip member: seeking is a simple offset change
+
+    def __init__(self, archive, offset, size):
+        io.RawIOBase.__init__(self)
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+        self.position = 0
+        archive.acquire()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+        data = self.archive.read_at(self.offset + self.position, size)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.archive.release()
+        io.RawIOBase.close(self)
+
+
+class SpillCache:
+    # compressed zip members, extracted so that they can be read with seeks
+    # the least recently used files are evicted when the cache exceeds max_size bytes
+
+    def __init__(self, directory=None, max_size=256*1024**2):
+        self.directory = os.path.join(directory or default_cache_dir(), 'playback')
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        # member keys contain the archive path: only its hash is used as a file name
+        return os.path.join(self.directory, hashlib.sha1(key.encode('UTF-8')).hexdigest() + '.mp3')
+
+    def open(self, zfile, zinfo, key):
+        cachepath = self.path(key)
+        try:
+            os.utime(cachepath)
+            return open(cachepath, 'rb')
+        except FileNotFoundError:
+            pass
+        fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file, zfile.open(zinfo, 'r', pwd=info) as member:
+                while (chunk := member.read(1024*1024)):
+                    file.write(chunk)
+            os.replace(temppath, cachepath)
+        except BaseException:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+        self.evict(keep=cachepath)
+        return open(cachepath, 'rb')
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.mp3'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                # on Windows, a file being played cannot be removed
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class PlaybackSources:
+    # seekable streams of the sounds, from plain files or zip members
+    # archives are kept open in a small pool, shared by the GUI and the loading threads
+
+    def __init__(self, max_archives=4, cache_dir=None, max_cache_size=256*1024**2):
+        self.max_archives = max_archives
+        self.archives = OrderedDict()
+        self.lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.max_cache_size = max_cache_size
+        self.spill_cache = None
+
+    def archive(self, path):
+        # the open archive, reopened if the file has changed
+        # it is acquired, so that it stays open until release() even if it leaves the pool
+        stat = os.stat(path)
+        with self.lock:
+            archive = self.archives.get(path)
+            if archive is not None and archive.stamp == (stat.st_mtime_ns, stat.st_size):
+                self.archives.move_to_end(path)
+                archive.acquire()
+                return archive
+            if archive is not None:
+                del self.archives[path]
+                archive.evict()
+            archive = SharedArchive(path)
+            archive.acquire()
+            self.archives[path] = archive
+            while len(self.archives) > self.max_archives:
+                _, oldest = self.archives.popitem(last=False)
+                oldest.evict()
+            return archive
+
+    def open(self, path, member=None):
+        if member is None:
+            return open(path, 'rb')
+        archive = self.archive(path)
+        try:
+            zinfo = archive.zfile.getinfo(member)
+            if zinfo.compress_type == zipfile.ZIP_STORED and not zinfo.flag_bits & 0x1:
+                return io.BufferedReader(MemberReader(archive, archive.data_offset(zinfo), zinfo.file_size))
+            with self.lock:
+                if self.spill_cache is None:
+                    self.spill_cache = SpillCache(self.cache_dir, self.max_cache_size)
+            return self.spill_cache.open(archive.zfile, zinfo, MediaIndex.member_key(path, zinfo))
+        finally:
+            archive.release()
+
+    def close(self):
+        with self.lock:
+            for archive in self.archives.values():
+                archive.evict()
+            self.archives.clear()
+
+
+class SoundPrefetcher:
+    # sounds read in advance in a background thread, kept in memory until max_size bytes,
+    # the least recently used ones are dropped beyond that
+    # entries are keyed by (soundpath, uuid), and checked against the modification time of the file
+
+    def __init__(self, sources, media_index, max_size=64*1024**2):
+        self.sources = sources
+        self.media_index = media_index
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.wanted = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    @staticmethod
+    def stamp(soundpath):
+        stat = os.stat(soundpath)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, soundpath, uuid):
+        # (data, duration) if the sound has been read, else None
+        try:
+            stamp = SoundPrefetcher.stamp(soundpath)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get((soundpath, uuid))
+            if entry is None or entry[0] != stamp:
+                return None
+            self.entries.move_to_end((soundpath, uuid))
+            return entry[1], entry[2]
+
+    def prefetch(self, sounds):
+        # list of (soundpath, uuid) to read, replaces the previous list
+        with self.lock:
+            self.wanted = list(sounds)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait()
+            self.wake.clear()
+            while not self.stopped:
+                with self.lock:
+                    todo = [key for key in self.wanted if key not in self.entries]
+                if not todo:
+                    break
+                try:
+                    self.load(*todo[0])
+                except Exception:
+                    # missing or unreadable sound, not retried
+                    with self.lock:
+                        if todo[0] in self.wanted:
+                            self.wanted.remove(todo[0])
+
+    def load(self, soundpath, uuid):
+        stamp = SoundPrefetcher.stamp(soundpath)
+        if soundpath[-4:] == '.zip':
+            filename = uuid + '.mp3'
+            archive = self.sources.archive(soundpath)
+            try:
+                duration = self.media_index.sound_info(soundpath, filename, zfile=archive.zfile)['duration']
+                with self.sources.open(soundpath, filename) as stream:
+                    data = stream.read()
+            finally:
+                archive.release()
+        else:
+            duration = self.media_index.sound_info(soundpath)['duration']
+            with self.sources.open(soundpath) as stream:
+                data = stream.read()
+        key = (soundpath, uuid)
+        with self.lock:
+            if key not in self.wanted:
+                return
+            # the sounds still wanted are kept, a sound that does not fit is not prefetched
+            for old_key in list(self.entries):
+                if self.size + len(data) <= self.max_size:
+                    break
+                if old_key not in self.wanted:
+                    self.size -= len(self.entries.pop(old_key)[1])
+            if self.size + len(data) > self.max_size:
+                self.wanted.remove(key)
+                return
+            self.entries[key] = (stamp, data, duration)
+            self.size += len(data)
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,420 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import itertools
+
+from io_utils import write_merlin_playlist
+
+
+# item types (the 32 flag marks items coming from the Merlin catalogue)
+TYPE_ROOT = 1
+TYPE_FAVORITES = 10
+TYPE_DISCOVER = 18
+
+INT_FIELDS = ('type', 'limit_time', 'add_time', 'fav_order', 'nb_children')
+# node attributes recorded in the journal when a node is added
+JOURNAL_FIELDS = ('type', 'title', 'uuid', 'imagepath', 'soundpath', 'limit_time', 'add_time')
+
+
+def is_directory_type(item_type):
+    return item_type%32 in [2, 6]
+
+
+def is_sound_type(item_type):
+    return item_type != TYPE_ROOT and item_type%32 not in [2, 6, 10, 18]
+
+
+class PlaylistNode:
+
+    __slots__ = ('iid', 'parent', 'children', 'type', 'title', 'uuid', 'imagepath', 'soundpath',
+                 'limit_time', 'add_time', 'fav_order', 'nb_children')
+
+    def __init__(self, iid, item_type, title='', uuid='', imagepath='', soundpath='',
+                 limit_time=0, add_time=0, fav_order=0, nb_children=0):
+        self.iid = iid
+        self.parent = None
+        self.children = []
+        self.type = item_type
+        self.title = title
+        self.uuid = uuid
+        self.imagepath = imagepath
+        self.soundpath = soundpath
+        self.limit_time = limit_time
+        self.add_time = add_time
+        # fav_order and nb_children are only kept as read, they are recomputed on serialization
+        self.fav_order = fav_order
+        self.nb_children = nb_children
+
+    def is_directory(self):
+        return is_directory_type(self.type)
+
+    def is_sound(self):
+        return is_sound_type(self.type)
+
+    def __repr__(self):
+        return f"PlaylistNode({self.iid!r}, {self.type}, {self.title!r})"
+
+
+class PlaylistModel:
+    # the playlist tree, independent of Tk
+    # nodes are identified by their iid, which is also used by the tree views
+
+    def __init__(self):
+        self.iid_counter = itertools.count(1)
+        # SessionJournal recording the edits, if any
+        self.journal = None
+        self.clear()
+
+    def clear(self):
+        self.root = PlaylistNode('', TYPE_ROOT, 'Root')
+        self.nodes = {'': self.root}
+        # special menus, not listed among the root children
+        self.favorite_menu = None
+        self.discover_menu = None
+        # favourite sounds, in the order of the favourites pane
+        self.favorites = []
+        # node -> position in favorites, rebuilt when needed after an edit
+        self.favorite_index = {}
+
+    @classmethod
+    def from_items(cls, items):
+        model = cls()
+        model.add_items(items)
+        return model
+
+    def new_iid(self):
+        return f"n{next(self.iid_counter)}"
+
+    def __contains__(self, iid):
+        return iid in self.nodes
+
+    def __len__(self):
+        return len(self.nodes) - 1
+
+    def node(self, iid):
+        return self.nodes[iid]
+
+    def children(self, iid=''):
+        return self.nodes[iid].children
+
+    def parent(self, iid):
+        parent = self.nodes[iid].parent
+        return parent.iid if parent else ''
+
+    def index(self, iid):
+        node = self.nodes[iid]
+        return node.parent.children.index(node)
+
+    def ancestors(self, iid):
+        res = []
+        node = self.nodes[iid].parent
+        while node is not None and node is not self.root:
+            res.append(node.iid)
+            node = node.parent
+        return res
+
+    def path(self, iid):
+        # indexes from the top level down to iid, the special menus are 'F' and 'D'
+        res = []
+        node = self.nodes[iid]
+        while node.parent is not None:
+            if node is self.favorite_menu:
+                res.append('F')
+                break
+            elif node is self.discover_menu:
+                res.append('D')
+                break
+            res.append(node.parent.children.index(node))
+            node = node.parent
+        return res[::-1]
+
+    def node_at(self, path):
+        node = self.root
+        for index in path:
+            if index == 'F':
+                node = self.favorite_menu
+            elif index == 'D':
+                node = self.discover_menu
+            else:
+                node = node.children[index]
+        return node.iid
+
+    def walk(self, iid=''):
+        # pre-order traversal of the descendants of iid
+        stack = list(reversed(self.nodes[iid].children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def insert(self, parent, index, item_type, title='', iid=None, **fields):
+        node = PlaylistNode(iid or self.new_iid(), item_type, title, **fields)
+        parent_node = self.nodes[parent]
+        node.parent = parent_node
+        if index == 'end':
+            parent_node.children.append(node)
+        else:
+            parent_node.children.insert(int(index), node)
+        self.nodes[node.iid] = node
+        if self.journal:
+            item = {key: getattr(node, key) for key in JOURNAL_FIELDS}
+            self.journal.append({'op': 'add', 'parent': self.path(parent), 'index': self.index(node.iid), 'item': item})
+        return node
+
+    def delete(self, iid):
+        # returns the iids of the deleted nodes
+        node = self.nodes[iid]
+        path = self.path(iid) if self.journal else None
+        removed = [node] + list(self.walk(iid))
+        if node.parent is not None and node in node.parent.children:
+            node.parent.children.remove(node)
+        for n in removed:
+            del self.nodes[n.iid]
+            if n is self.favorite_menu:
+                self.favorite_menu = None
+            elif n is self.discover_menu:
+                self.discover_menu = None
+        index = self.favorite_positions()
+        if any(n in index for n in removed):
+            removed_set = set(removed)
+            self.favorites = [n for n in self.favorites if n not in removed_set]
+            self.favorite_index = None
+        if self.journal:
+            self.journal.append({'op': 'delete', 'path': path})
+        return [n.iid for n in removed]
+
+    def move(self, iid, parent, index):
+        # same semantics as Treeview.move: detach the node, then insert it at index
+        node = self.nodes[iid]
+        parent_node = self.nodes[parent]
+        if parent == iid or iid in self.ancestors(parent):
+            raise ValueError("cannot move a node into itself")
+        if self.journal:
+            paths = self.path(iid), self.path(parent)
+        node.parent.children.remove(node)
+        node.parent = parent_node
+        if index == 'end':
+            parent_node.children.append(node)
+        else:
+            parent_node.children.insert(max(0, int(index)), node)
+        if self.journal:
+            self.journal.append({'op': 'move', 'path': paths[0], 'parent': paths[1], 'index': self.index(iid)})
+
+    def set_title(self, iid, title):
+        self.nodes[iid].title = title
+        if self.journal:
+            self.journal.append({'op': 'title', 'path': self.path(iid), 'title': title})
+
+    def set_imagepath(self, iid, imagepath):
+        self.nodes[iid].imagepath = imagepath
+        if self.journal:
+            self.journal.append({'op': 'imagepath', 'path': self.path(iid), 'imagepath': imagepath})
+
+
+    def favorite_positions(self):
+        # {node: position in the favourites pane}
+        if self.favorite_index is None:
+            self.favorite_index = {node: position for position, node in enumerate(self.favorites)}
+        return self.favorite_index
+
+    def is_favorite(self, iid):
+        return self.nodes[iid] in self.favorite_positions()
+
+    def add_favorite(self, iid, index='end'):
+        node = self.nodes[iid]
+        if node in self.favorite_positions():
+            return
+        if index == 'end' or int(index) >= len(self.favorites):
+            # appending keeps the index valid
+            self.favorite_index[node] = len(self.favorites)
+            self.favorites.append(node)
+        else:
+            self.favorites.insert(max(0, int(index)), node)
+            self.favorite_index = None
+        if self.journal:
+            self.journal.append({'op': 'favorite', 'path': self.path(iid), 'index': self.favorite_positions()[node]})
+
+    def remove_favorite(self, iid):
+        node = self.nodes[iid]
+        position = self.favorite_positions().get(node)
+        if position is None:
+            return
+        del self.favorites[position]
+        if position == len(self.favorites):
+            del self.favorite_index[node]
+        else:
+            self.favorite_index = None
+        if self.journal:
+            self.journal.append({'op': 'unfavorite', 'path': self.path(iid)})
+
+    def move_favorite(self, iid, index):
+        node = self.nodes[iid]
+        del self.favorites[self.favorite_positions()[node]]
+        if index == 'end':
+            self.favorites.append(node)
+        else:
+            self.favorites.insert(max(0, int(index)), node)
+        self.favorite_index = None
+        if self.journal:
+            self.journal.append({'op': 'move_favorite', 'path': self.path(iid), 'index': self.favorite_positions()[node]})
+
+    def apply(self, op):
+        # replay an edit recorded in a journal
+        kind = op['op']
+        if kind == 'add':
+            fields = dict(op['item'])
+            item_type = fields.pop('type')
+            self.insert(self.node_at(op['parent']), op['index'], item_type, **fields)
+        elif kind == 'delete':
+            self.delete(self.node_at(op['path']))
+        elif kind == 'move':
+            self.move(self.node_at(op['path']), self.node_at(op['parent']), op['index'])
+        elif kind == 'title':
+            self.set_title(self.node_at(op['path']), op['title'])
+        elif kind == 'imagepath':
+            self.set_imagepath(self.node_at(op['path']), op['imagepath'])
+        elif kind == 'favorite':
+            self.add_favorite(self.node_at(op['path']), op['index'])
+        elif kind == 'unfavorite':
+            self.remove_favorite(self.node_at(op['path']))
+        elif kind == 'move_favorite':
+            self.move_favorite(self.node_at(op['path']), op['index'])
+        else:
+            raise ValueError(f"unknown journal operation {kind!r}")
+
+    def sort_favorites(self):
+        # order the favourites by their fav_order as read
+        self.favorites.sort(key=lambda node: node.fav_order, reverse=True)
+        self.favorite_index = None
+
+    def fav_order(self, node):
+        # the first favourite of the pane has the highest fav_order
+        position = self.favorite_positions().get(node)
+        if position is None:
+            return 0
+        return len(self.favorites) - position
+
+
+    def shares_top_level(self, items):
+        # True if an item at the top of items has the same title and uuid as a top-level node
+        top = {(node.title, node.uuid) for node in self.root.children}
+        return any((item['title'], item['uuid']) in top for item in items if item['parent_id']==1)
+
+    def add_items(self, items, merge=False, parents=None):
+        # add a list of playlist items (as read from playlist.bin or a session)
+        # with merge, items with the same parent, title and uuid as an existing node are combined with it
+        # parents maps item ids to existing nodes the items are added under, by default the root
+        # returns a report listing the iids of matched, added and conflicting nodes
+        report = {'merged': merge, 'matched': [], 'added': [], 'conflicting': []}
+        if merge:
+            index = dict()
+            titles = dict()
+            uuids = dict()
+            for node in self.walk():
+                parent = node.parent.iid
+                index.setdefault((parent, node.title, node.uuid), node)
+                titles.setdefault((parent, node.title), node)
+                uuids.setdefault((parent, node.uuid), node)
+
+        children = dict()
+        for item in items:
+            children.setdefault(item['parent_id'], []).append(item)
+        for siblings in children.values():
+            siblings.sort(key=lambda item: item['order'])
+
+        new_favorites = []
+        if parents is None:
+            parents = {1: self.root}
+        stack = [(item, parent_node) for parent_id, parent_node in parents.items() 
+                                     for item in reversed(children.get(parent_id, []))]
+        visited = set()
+        while stack:
+            item, parent_node = stack.pop()
+            if item['id'] in visited:
+                continue
+            visited.add(item['id'])
+            item_type = int(item['type'] or 0)
+            if item_type == TYPE_ROOT:
+                continue
+
+            node = None
+            if merge:
+                node = index.get((parent_node.iid, item['title'], item['uuid']))
+                if node is not None:
+                    report['matched'].append(node.iid)
+            if node is None:
+                if item_type in {10,42}:
+                    if self.favorite_menu:
+                        continue
+                elif item_type in {18,50}:
+                    if self.discover_menu:
+                        continue
+                fields = {key: int(item[key] or 0) for key in INT_FIELDS if key != 'type'}
+                node = PlaylistNode(self.new_iid(), item_type, item['title'], item['uuid'],
+                                    item.get('imagepath', ''), item.get('soundpath', ''), **fields)
+                node.parent = parent_node
+                self.nodes[node.iid] = node
+                if item_type%32 == 10:
+                    self.favorite_menu = node
+                elif item_type%32 == 18:
+                    self.discover_menu = node
+                else:
+                    parent_node.children.append(node)
+                report['added'].append(node.iid)
+                if node.is_sound() and node.fav_order > 0:
+                    new_favorites.append(node)
+                if merge:
+                    key = (parent_node.iid, node.title)
+                    if key in titles or (parent_node.iid, node.uuid) in uuids:
+                        # same title or same file as an existing node, but not both
+                        report['conflicting'].append(node.iid)
+                    index[(parent_node.iid, node.title, node.uuid)] = node
+                    titles.setdefault(key, node)
+                    uuids.setdefault((parent_node.iid, node.uuid), node)
+            stack.extend((child, node) for child in reversed(children.get(item['id'], [])))
+
+        new_favorites.sort(key=lambda node: node.fav_order, reverse=True)
+        self.favorites.extend(new_favorites)
+        self.favorite_index = None
+        return report
+
+
+    def node_to_item(self, node, id, parent_id, order, nb_children, fav_order):
+        return {'id': id, 'parent_id': parent_id, 'order': order, 'nb_children': nb_children,
+                'fav_order': fav_order, 'type': node.type, 'limit_time': node.limit_time,
+                'add_time': node.add_time, 'uuid': node.uuid, 'title': node.title,
+                'imagepath': node.imagepath, 'soundpath': node.soundpath}
+
+    def iter_items(self):
+        # playlist items in pre-order, with ids, orders and number of children assigned on the fly
+        # iterative, so that deep menus do not hit the recursion limit
+        top = self.root.children
+        nb_root_children = len(top) + (self.favorite_menu is not None) + (self.discover_menu is not None)
+        yield self.node_to_item(self.root, 1, 0, 0, nb_root_children, 0)
+        counter = 1
+        # (node, order, parent id), the next node to yield at the end
+        stack = [(top[order], order, 1) for order in range(len(top)-1, -1, -1)]
+        while stack:
+            node, order, parent_id = stack.pop()
+            counter += 1
+            children = node.children
+            yield self.node_to_item(node, counter, parent_id, order, len(children), self.fav_order(node))
+            stack.extend((children[order], order, counter) for order in range(len(children)-1, -1, -1))
+        order = len(top)
+        if self.favorite_menu:
+            counter += 1
+            yield self.node_to_item(self.favorite_menu, counter, 1, order, len(self.favorites), self.favorite_menu.fav_order)
+            order += 1
+        if self.discover_menu:
+            counter += 1
+            yield self.node_to_item(self.discover_menu, counter, 1, order, self.discover_menu.nb_children, self.discover_menu.fav_order)
+
+    def to_items(self):
+        return list(self.iter_items())
+
+    def write_playlist(self, stream):
+        return write_merlin_playlist(stream, self.iter_items())
@@ -0,0 +1,205 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import os.path
+import json, io
+import zlib
+
+from io_utils import write_file_atomic
+from playlist_model import PlaylistModel
+from session_snapshot import encode_session, decode_session
+
+
+class SessionJournal:
+    # append-only log of the edits made to a session since its last snapshot
+    # the snapshot is the session file itself, the journal is written next to it:
+    # a header line with the crc of the snapshot, then one json record per edit
+
+    def __init__(self, sessionpath, compact_every=1000):
+        self.sessionpath = sessionpath
+        self.path = sessionpath + '.journal'
+        self.compact_every = compact_every
+        self.model = None
+        self.file = None
+        self.offsets = []
+        self.nb_records = 0
+        # set when an edit could not be written, autosave stops until the next compaction
+        self.error = None
+
+
+    def read_records(self, snapshot):
+        # returns the records that apply to snapshot, and their offsets in the journal
+        # followed by the length of its valid part (an empty list if there is no valid journal)
+        try:
+            with open(self.path, 'rb') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return [], []
+        records = []
+        offsets = []
+        offset = 0
+        for line in lines:
+            if not line.endswith(b'\n'):
+                # last record interrupted by a crash
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if offset == 0 and record != self.header(snapshot):
+                # journal of an older snapshot, its edits are already in the session file
+                return [], []
+            elif offset:
+                records.append(record)
+                offsets.append(offset)
+            offset += len(line)
+        if offset:
+            offsets.append(offset)
+        return records, offsets
+
+
+    @staticmethod
+    def header(snapshot):
+        return {'op': 'snapshot', 'crc': zlib.crc32(snapshot)}
+
+
+    def open(self):
+        # returns the snapshot and the records of the journal that apply to it
+        with open(self.sessionpath, 'rb') as file:
+            snapshot = file.read()
+        records, self.offsets = self.read_records(snapshot)
+        # the journal is continued, without the interrupted record if any
+        if self.offsets:
+            self.file = open(self.path, 'r+b')
+            self.truncate(len(records))
+        else:
+            self.start_journal(snapshot)
+        return snapshot, records
+
+
+    def truncate(self, nb_records):
+        # keep the first nb_records records only, the next edits are written after them
+        # used when a record does not apply: the records after it would never be replayed
+        offset = self.offsets[nb_records]
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.offsets = self.offsets[:nb_records+1]
+        self.nb_records = nb_records
+
+
+    @staticmethod
+    def replay(items, records):
+        # returns the items with the records applied, and the number of records that applied
+        model = PlaylistModel.from_items(items)
+        nb_applied = 0
+        for record in records:
+            try:
+                model.apply(record)
+            except (KeyError, IndexError, ValueError, AttributeError):
+                # inconsistent record, the following ones cannot apply either
+                break
+            nb_applied += 1
+        return model.to_items(), nb_applied
+
+
+    def load(self):
+        # items of the session, with the edits of the journal replayed
+        snapshot, records = self.open()
+        items = decode_session(snapshot)
+        if records:
+            items, nb_applied = self.replay(items, records)
+            if nb_applied < len(records):
+                self.truncate(nb_applied)
+        return items
+
+
+    def attach(self, model):
+        # record the edits of model from now on
+        if self.model is not None and self.model.journal is self:
+            self.model.journal = None
+        self.model = model
+        model.journal = self
+
+
+    def start_journal(self, snapshot):
+        if self.file:
+            self.file.close()
+        header = json.dumps(self.header(snapshot)) + '\n'
+        write_file_atomic(self.path, io.BytesIO(header.encode('utf-8')))
+        self.file = open(self.path, 'ab')
+        self.offsets = [len(header.encode('utf-8'))]
+        self.nb_records = 0
+        self.error = None
+
+
+    def is_binary(self):
+        return os.path.splitext(self.sessionpath)[1].lower() == '.mls'
+
+
+    def compact(self):
+        # write a snapshot of the model to the session file, and start a new journal
+        if self.is_binary():
+            snapshot = encode_session(self.model.iter_items())
+        else:
+            snapshot = json.dumps(self.model.to_items(), indent=2).encode('utf-8')
+        write_file_atomic(self.sessionpath, io.BytesIO(snapshot))
+        # a crash here leaves the old journal, which no longer matches the snapshot and is ignored
+        self.start_journal(snapshot)
+
+
+    def append(self, record):
+        if self.file is None:
+            return
+        try:
+            line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+            self.file.write(line)
+            self.file.flush()
+            self.offsets.append(self.offsets[-1] + len(line))
+            self.nb_records += 1
+            if self.nb_records >= self.compact_every:
+                self.compact()
+        except OSError as e:
+            self.error = e
+            self.file.close()
+            self.file = None
+
+
+    def close(self):
+        # the model may already be recorded by another journal, as after "save as"
+        if self.model is not None and self.model.journal is self:
+            self.model.journal = None
+        self.model = None
+        if self.file:
+            try:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError:
+                pass
+            self.file.close()
+            self.file = None
+
+
+def read_session(sessionpath):
+    # items of a session with its journal replayed, no file is modified
+    journal = SessionJournal(sessionpath)
+    with open(sessionpath, 'rb') as file:
+        snapshot = file.read()
+    records, _ = journal.read_records(snapshot)
+    items = decode_session(snapshot)
+    if records:
+        items, _ = journal.replay(items, records)
+    return items
+
+
+def write_session(sessionpath, model):
+    # save model as a new snapshot of the session
+    journal = SessionJournal(sessionpath)
+    journal.attach(model)
+    try:
+        journal.compact()
+    finally:
+        journal.close()
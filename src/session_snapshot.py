@@ -0,0 +1,114 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import json
+import struct
+
+from io_utils import playlist_record, RECORD_SIZE, pack_merlin_record, decode_merlin_record
+
+
+# binary session file (little endian):
+# header: magic, number of records, number of strings, offsets of the path, string and index tables
+# records: playlist.bin records, in pre-order
+# paths: for each record, ids of the directory (with its trailing separator) and of the name
+#        of its imagepath and soundpath (0 is '')
+# strings: UTF-8, separated by a null byte, directories and names are stored once
+# index: first record and number of records of each top-level subtree
+SESSION_MAGIC = b'MLS1'
+session_header = struct.Struct('<4s5I')
+path_entry = struct.Struct('<4I')
+index_entry = struct.Struct('<2I')
+
+
+def is_session_snapshot(data):
+    return data[:len(SESSION_MAGIC)] == SESSION_MAGIC
+
+
+def encode_session(items):
+    records = bytearray()
+    paths = bytearray()
+    strings = {'': 0}
+    index = []
+    record = bytearray(RECORD_SIZE)
+
+    def string_id(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    for count, item in enumerate(items):
+        pack_merlin_record(record, 0, item)
+        records += record
+        ids = []
+        for key in ('imagepath', 'soundpath'):
+            path = item.get(key, '')
+            i = max(path.rfind('/'), path.rfind('\\')) + 1
+            ids += [string_id(path[:i]), string_id(path[i:])]
+        paths += path_entry.pack(*ids)
+        if item['parent_id'] == 1:
+            index.append([count, 1])
+        elif index:
+            index[-1][1] += 1
+
+    string_table = '\0'.join(strings).encode('UTF-8') # in id order
+    paths_offset = session_header.size + len(records)
+    strings_offset = paths_offset + len(paths)
+    index_offset = strings_offset + len(string_table)
+    header = session_header.pack(SESSION_MAGIC, len(records)//RECORD_SIZE, len(strings),
+                                 paths_offset, strings_offset, index_offset)
+    return b''.join([header, records, paths, string_table] + [index_entry.pack(*entry) for entry in index])
+
+
+def decode_session(data):
+    # items of a session file, binary or json
+    if is_session_snapshot(data):
+        return SessionSnapshot(data).all_items()
+    return json.loads(data)
+
+
+class SessionSnapshot:
+    # reader of a binary session, records are decoded on demand
+
+    def __init__(self, data):
+        if not is_session_snapshot(data):
+            raise Exception("wrong file format")
+        self.data = memoryview(data)
+        (_, self.nb_records, nb_strings, self.paths_offset,
+         strings_offset, index_offset) = session_header.unpack_from(data)
+        self.strings = str(self.data[strings_offset:index_offset], 'UTF-8').split('\0')
+        if len(self.strings) != nb_strings:
+            raise Exception("wrong file format")
+        self.index = list(index_entry.iter_unpack(self.data[index_offset:]))
+
+    def items(self, start, stop):
+        strings = self.strings
+        records = playlist_record.iter_unpack(self.data[session_header.size+start*RECORD_SIZE:session_header.size+stop*RECORD_SIZE])
+        paths = path_entry.iter_unpack(self.data[self.paths_offset+start*path_entry.size:self.paths_offset+stop*path_entry.size])
+        res = []
+        for fields, (image_dir, image_name, sound_dir, sound_name) in zip(records, paths):
+            item = decode_merlin_record(fields)
+            item['imagepath'] = strings[image_dir] + strings[image_name]
+            item['soundpath'] = strings[sound_dir] + strings[sound_name]
+            res.append(item)
+        return res
+
+    def all_items(self):
+        return self.items(0, self.nb_records)
+
+    def top_level_items(self):
+        # the root and the top-level items, enough to display the first level of the tree
+        res = self.items(0, 1)
+        for first, _ in self.index:
+            res += self.items(first, first+1)
+        return res
+
+    def subtree_items(self):
+        # everything below the top-level items
+        res = []
+        for first, count in self.index:
+            res += self.items(first+1, first+count)
+        return res
@@ -0,0 +1,150 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the 
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+from PIL import Image
+import os.path, io
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from io_utils import IsImageProgressive, info
+from audio_converter import default_cache_dir
+from media_index import MediaIndex
+
+
+THUMBNAIL_SIZE = (40, 40)
+
+
+def make_thumbnail(open_image, image_info=None):
+    # returns the 40x40 thumbnail, or None if the image is a progressive JPEG
+    # image_info, if given, is filled with the size and progressive flag of the image
+    with open_image() as imagestream:
+        data = imagestream.read()
+    progressive = IsImageProgressive(io.BytesIO(data))
+    if image_info is not None:
+        with Image.open(io.BytesIO(data)) as image:
+            image_info.update(width=image.size[0], height=image.size[1], progressive=progressive)
+    if progressive:
+        return None
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEGs are decoded directly at 1/2, 1/4 or 1/8 of their size
+        image.draft('RGB', THUMBNAIL_SIZE)
+        image_small = image.resize(THUMBNAIL_SIZE, Image.ANTIALIAS)
+    return image_small
+
+
+def decode_thumbnails(jobs, max_workers=None):
+    # run {uuid: job} on a thread pool (Pillow releases the GIL while decoding)
+    # returns {uuid: thumbnail}; PhotoImages must then be created in the Tk thread
+    if len(jobs) < 2:
+        return {uuid: job() for uuid, job in jobs.items()}
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, (os.cpu_count() or 1)+2)) as executor:
+        futures = {uuid: executor.submit(job) for uuid, job in jobs.items()}
+        return {uuid: future.result() for uuid, future in futures.items()}
+
+
+class ThumbnailCache:
+    # ready-made thumbnails, keyed by uuid and source file mtime/size or zip member CRC
+    # progressive JPEGs are remembered as empty entries
+    
+    def __init__(self, directory=None, max_entries=20000, media_index=None):
+        self.directory = os.path.join(directory or default_cache_dir(), 'thumbnails')
+        self.max_entries = max_entries
+        # images decoded here are recorded in the media index, and known progressive JPEGs are not read
+        self.media_index = media_index
+        self.nb_added = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError:
+            self.directory = None
+    
+    @staticmethod
+    def file_key(uuid, imagepath):
+        stat = os.stat(imagepath)
+        return f"{uuid}|{os.path.abspath(imagepath)}|{stat.st_mtime_ns}|{stat.st_size}"
+    
+    @staticmethod
+    def member_key(uuid, zinfo):
+        return f"{uuid}|{zinfo.filename}|{zinfo.CRC:08x}|{zinfo.file_size}"
+    
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('UTF-8')).hexdigest() + '.png')
+    
+    def get(self, key):
+        # returns (found, thumbnail)
+        if not self.directory:
+            return False, None
+        path = self.path(key)
+        try:
+            if os.path.getsize(path) == 0:
+                return True, None
+            with Image.open(path) as image:
+                image.load()
+                return True, image.copy()
+        except (OSError, ValueError):
+            return False, None
+    
+    def put(self, key, image):
+        if not self.directory:
+            return
+        try:
+            fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                if image is not None:
+                    image.save(file, "PNG")
+            os.replace(temppath, self.path(key))
+            self.nb_added += 1
+        except OSError:
+            pass
+    
+    def prune(self):
+        # drop the least recently written entries beyond max_entries
+        if not self.directory or not self.nb_added:
+            return
+        self.nb_added = 0
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries)-self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def make_thumbnail(self, media_key, open_image):
+        if self.media_index is None:
+            return make_thumbnail(open_image)
+        known = self.media_index.get(media_key)
+        if known and known.get('progressive'):
+            return None
+        image_info = dict()
+        image = make_thumbnail(open_image, image_info)
+        self.media_index.put(media_key, image_info)
+        return image
+    
+    def thumbnail_from_file(self, uuid, imagepath):
+        key = ThumbnailCache.file_key(uuid, imagepath)
+        found, image = self.get(key)
+        if not found:
+            image = self.make_thumbnail(MediaIndex.file_key(imagepath), lambda: open(imagepath, 'rb'))
+            self.put(key, image)
+        return image
+    
+    def thumbnail_from_zip(self, uuid, zfile, zinfo):
+        key = ThumbnailCache.member_key(uuid, zinfo)
+        found, image = self.get(key)
+        if not found:
+            image = self.make_thumbnail(MediaIndex.member_key(zfile.filename, zinfo), lambda: zfile.open(zinfo, 'r', pwd=info))
+            self.put(key, image)
+        return image
@@ -6,15 +6,16 @@
 
 
 import tkinter as tk
+from tkinter import filedialog, messagebox
 from tkinter.ttk import Treeview
 from PIL import Image, ImageTk
-import os.path, shutil, uuid
+import os.path, uuid
 from time import time
-import logging
-from pydub import AudioSegment
-from mutagen.mp3 import MP3
 
 from io_utils import *
+from audio_converter import TranscodePool
+from playlist_model import PlaylistModel
+from gui_actions import ProgressDialog
 
 
 
@@ -63,30 +64,39 @@ class MerlinTree(Treeview):
         self.bind_class('Treeview', '<Left>', self.boundLeft)
         
         
+    def selected(self):
+        # the trees are in 'browse' mode: the iid of the selected node, or '' if there is none
+        # (selection() returns a tuple, the model expects a single iid)
+        selection = self.selection()
+        return selection[0] if selection else ''
+        
     def moveUp(self, *args):
-        node = self.selection()
+        node = self.selected()
         if node:
-            self.move(node, self.parent(node), self.index(node)-1)
+            self.move_node(node, self.parent(node), self.index(node)-1)
             self.see(node)
             self.rootGUI.sync_buttons_main()
             self.rootGUI.sync_buttons_fav()
             
     def moveDown(self, *args):
-        node = self.selection()
+        node = self.selected()
         if node:
-            self.move(node, self.parent(node), self.index(node)+1)
+            self.move_node(node, self.parent(node), self.index(node)+1)
             self.see(node)
             self.rootGUI.sync_buttons_main()
             self.rootGUI.sync_buttons_fav()
             
     def moveParentDir(self, *args):
-        node = self.selection()
+        node = self.selected()
         if node and self.parent(node) != '':
-            self.move(node, self.parent(self.parent(node)), 'end')
+            self.move_node(node, self.parent(self.parent(node)), 'end')
             self.see(node)
             self.rootGUI.sync_buttons_main()
             self.rootGUI.sync_buttons_fav()
 
+    def move_node(self, node, parent, index):
+        self.move(node, parent, index)
+
     def get_ancestors(self, node):
         res = [node]
         parent = self.parent(node)
@@ -124,6 +134,10 @@ class MerlinMainTree(MerlinTree):
         self.currently_selected = []
         self.iid_Merlin_favorite = None
         self.iid_Merlin_discover = None
+        # the playlist itself, the tree only displays it
+        self.model = PlaylistModel()
+        # menus not opened yet: iid -> placeholder iid
+        self.pending = dict()
 
 
         self["columns"] = MerlinMainTree.COL
@@ -146,9 +160,11 @@ class MerlinMainTree(MerlinTree):
             # self.heading(key, text=key, anchor=tk.W)
         
         self.tag_configure("directory", foreground="grey")
+        self.bind('<<TreeviewOpen>>', self.on_open)
         
     
-    def populate(self, items, thumbnails, overwrite):
+    def populate(self, items, overwrite):
+        model = self.model
         if overwrite:
             # clear existing data
             for c in self.get_children():
@@ -159,141 +175,161 @@ class MerlinMainTree(MerlinTree):
             if self.iid_Merlin_favorite:
                 self.delete(self.iid_Merlin_favorite)
                 self.iid_Merlin_favorite = None
+            self.pending = dict()
+            model.clear()
+            model.add_items(items)
+            # only the top-level menus are inserted now, the rest when they are opened
+            self.insert_nodes('', model.children(''))
+            self.insert_special_nodes()
+            for node in model.favorites:
+                self.reveal(node.iid)
+            self.update()
+            return None
         
-        mapiid = dict()
-        mapiid[1] = ''
-        offsets = dict()
-        offsets[''] = len(self.get_children())
-        
-        merge = False
-        for item in (item for item in items if item['parent_id']==1):
-            for c in self.get_children():
-                if self.item(c, 'text')[3:] == item['title'] and \
-                   self.set(c, 'uuid') == item['uuid']:
-                    merge = True
-                    break
-            if merge:
-                break
+        merge = model.shares_top_level(items)
         if merge:
             self.focus_force()
             question = "Les playlists ont des éléments en commun. Fusionner les deux playlist?\n(cliquer sur Non pour joindre la nouvelle playlist à la fin)"
             answer = tk.messagebox.askyesno("Fusionner?",question)
             if not answer:
                 merge = False
+        report = model.add_items(items, merge)
         
-        # adding data
-        for item in items:
-            favorite = '♥' if item['fav_order'] else ''
-            data = tuple([ favorite] + \
-                [item[key] for key in MerlinMainTree.COL[1:]])
-            iid = item['id']
-            if item['parent_id']==1:
-                parent = ''
+        # display the new nodes whose parent is displayed and open
+        added = set(report['added'])
+        new_children = dict()
+        for iid in report['added']:
+            node = model.node(iid)
+            parent = model.parent(iid)
+            if parent not in added and node is not model.favorite_menu and node is not model.discover_menu:
+                new_children.setdefault(parent, []).append(node)
+        for parent, nodes in new_children.items():
+            # menus not opened yet will show their new children when opened
+            if parent == '' or (self.exists(parent) and parent not in self.pending):
+                self.insert_nodes(parent, nodes)
+        self.insert_special_nodes()
+        for node in model.favorites:
+            if not self.exists(node.iid):
+                self.reveal(node.iid)
+        self.update()
+        return report
+    
+    
+    def add_subtrees(self, items, parents):
+        # items below top-level menus that are already displayed, parents maps their ids to the nodes
+        model = self.model
+        model.add_items(items, parents=parents)
+        for node in parents.values():
+            if node.children and not self.get_children(node.iid):
+                self.pending[node.iid] = self.insert(node.iid, 'end', text='', tags='placeholder')
+        model.sort_favorites()
+        for node in model.favorites:
+            if not self.exists(node.iid):
+                self.reveal(node.iid)
+    
+    
+    def node_values(self, node):
+        favorite = '♥' if self.model.is_favorite(node.iid) else ''
+        parent = node.parent.iid if node.parent else ''
+        return (favorite, node.imagepath, node.soundpath, node.iid, parent, '', '', 
+                node.fav_order, node.type, node.limit_time, node.add_time, node.uuid, node.title)
+    
+    
+    def insert_node(self, parent, index, node):
+        if node.type%32 in [2, 6, 10, 18]: # directory, favoris, ajouts récents
+            text = ' \u25AE ' + node.title
+            tags = "directory"
+        else:
+            text = ' \u266A ' + node.title
+            if self.model.is_favorite(node.iid):
+                tags = ("sound", "favorite")
             else:
-                parent = item['parent_id']
-            if item['type']==1: # root
-                continue
-            elif item['type'] in {10,42} and self.iid_Merlin_favorite: # favoris
-                continue
-            elif item['type'] in {18,50} and self.iid_Merlin_discover: # ajouts récents
-                continue
-            
-            data = tuple([ favorite] + \
-                [item[key] for key in MerlinMainTree.COL[1:]])
-            parent = mapiid[item['parent_id']]
-            
-            if merge:
-                for c in self.get_children(parent):
-                    if self.item(c, 'text')[3:] == item['title'] and \
-                       self.set(c, 'uuid') == item['uuid']:
-                        mapiid[item['id']] = c
-                        offsets[c] = len(self.get_children(c))
-                        break
-                if item['id'] in mapiid:
-                    offsets[parent] -= 1
-                    continue
-            
-            iid = self.insert(parent, item['order']+offsets[parent], text=item['title'], values=data, image=thumbnails[item['uuid']])
-            mapiid[item['id']] = iid
-            offsets[iid] = 0
-            self.set(iid, 'id', iid)
-            self.set(iid, 'parent_id', parent)
-            
+                tags = "sound"
+        iid = self.insert(parent, index, iid=node.iid, text=text, values=self.node_values(node), 
+                          image=self.rootGUI.thumbnails.get(node.uuid, ''), tags=tags)
+        if node.children:
+            # placeholder child, so that the menu can be opened
+            self.pending[iid] = self.insert(iid, 'end', text='', tags='placeholder')
+        return iid
+    
+    
+    def insert_nodes(self, parent, nodes):
+        # nodes must follow each other among the children of parent
+        if not nodes:
+            return
+        self.load_node_thumbnails(nodes)
+        index = self.model.index(nodes[0].iid)
+        for offset, node in enumerate(nodes):
+            self.insert_node(parent, index+offset, node)
+    
+    
+    def insert_special_nodes(self):
+        model = self.model
+        if model.favorite_menu and not self.iid_Merlin_favorite:
+            self.load_node_thumbnails([model.favorite_menu])
+            self.iid_Merlin_favorite = self.insert_node('', 'end', model.favorite_menu)
+            self.detach(self.iid_Merlin_favorite)
+        if model.discover_menu and not self.iid_Merlin_discover:
+            self.load_node_thumbnails([model.discover_menu])
+            self.iid_Merlin_discover = self.insert_node('', 'end', model.discover_menu)
+            self.detach(self.iid_Merlin_discover)
+    
+    
+    def load_node_thumbnails(self, nodes):
+        self.rootGUI.load_thumbnails([{'uuid': node.uuid, 'imagepath': node.imagepath} for node in nodes], overwrite=False)
+    
+    
+    def materialize(self, node='', recursive=True):
+        # insert the children of menus that have not been opened yet
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node in self.pending:
+                placeholder = self.pending.pop(node)
+                if self.exists(placeholder):
+                    self.delete(placeholder)
+                self.insert_nodes(node, self.model.children(node))
+            if recursive:
+                stack.extend(child.iid for child in self.model.children(node))
+    
+    
+    def reveal(self, node):
+        # make sure that node is in the tree, by opening the menus above it
+        for ancestor in reversed(self.model.ancestors(node)):
+            self.materialize(ancestor, recursive=False)
+    
+    
+    def on_open(self, event=None):
+        node = self.focus()
+        if node in self.pending:
+            self.materialize(node, recursive=False)
             
-            if item['type']%32 in [2, 6]: # directory 
-                self.item(iid, tags="directory")
-                self.item(iid, text=' \u25AE ' + self.item(iid, 'text'))
-            elif item['type']%32 == 10: # favoris
-                self.item(iid, tags="directory")
-                self.item(iid, text=' \u25AE ' + self.item(iid, 'text'))
-                self.iid_Merlin_favorite = iid
-                self.detach(iid)
-            elif item['type']%32==18: # ajouts récents
-                self.item(iid, tags="directory")
-                self.item(iid, text=' \u25AE ' + self.item(iid, 'text'))
-                self.iid_Merlin_discover = iid
-                self.detach(iid)
-            else:
-                self.item(iid, text=' \u266A ' + self.item(iid, 'text'))
-                if item['fav_order']>0:
-                    self.item(iid, tags=("sound", "favorite"))
-                else:
-                    self.item(iid, tags="sound")
-                
-        self.update()
-                
         
     def make_item_list(self):
-        
-        root_item = MerlinMainTree.rootItem
-        children = self.get_children('')
-        root_item['nb_children'] = len(children)
-        items = [root_item]
-        self.nb_fav = len(self.tag_has("favorite"))
-        counter = 1
-        for order, c in enumerate(children):
-            sublist, counter = self.subtree_to_list(c, counter, order)
-            items.extend(sublist)
-        order = len(children)
-        if self.iid_Merlin_favorite:
-            item = format_item(self.set(self.iid_Merlin_favorite))
-            counter += 1
-            item['id'] = counter
-            item['order'] = order
-            order += 1
-            item['parent_id'] = root_item['id']
-            root_item['nb_children'] += 1
-            item['nb_children'] = self.nb_fav
-            items.append(item)
-        if self.iid_Merlin_discover:
-            item = format_item(self.set(self.iid_Merlin_discover))
-            counter += 1
-            item['id'] = counter
-            item['order'] = order
-            order += 1
-            item['parent_id'] = root_item['id']
-            root_item['nb_children'] += 1
-            items.append(item)
-        
-        return items
-        
-        
-    def subtree_to_list(self, node, counter=0, order=0, parent=1):
-        item = format_item(self.set(node))
-        children = self.get_children(node)
-        counter += 1
-        item['id'] = counter
-        item['order'] = order
-        item['parent_id'] = parent
-        item['nb_children'] = len(children)
-        item['title'] = self.item(node, "text")[3:]
-        if self.tag_has('favorite', node):
-            item['fav_order'] = self.nb_fav - self.rootGUI.fav_tree.index(node)
-        items = [item]
-        for order, c in enumerate(children):
-            sublist, counter = self.subtree_to_list(c, counter, order, item['id'])
-            items.extend(sublist)
-        return items, counter
+        return self.model.to_items()
+    
+    
+    def iter_items(self):
+        return self.model.iter_items()
+    
+    
+    def move_node(self, node, parent, index):
+        self.materialize(parent, recursive=False)
+        self.model.move(node, parent, index)
+        self.move(node, parent, index)
+    
+    
+    def rename(self, node, title):
+        self.model.set_title(node, title)
+        if self.tag_has("directory", node):
+            text = ' \u25AE ' + title
+        else:
+            text = ' \u266A ' + title
+        self.item(node, text=text)
+        self.set(node, 'title', title)
+        fav_tree = self.rootGUI.fav_tree
+        if fav_tree.exists(node):
+            fav_tree.item(node, text=text)
            
     def set_selection(self, *args):
         self.current_selection = self.selection()
@@ -306,15 +342,18 @@ class MerlinMainTree(MerlinTree):
     def deleteNode(self, event=None, forceNode=None):
         if forceNode:
             node = forceNode
-            if (children:=self.get_children(node)):
-                for child in children:
-                    self.deleteNode(event, child)
             fav_tree = self.rootGUI.fav_tree
-            if fav_tree.exists(node):
-                fav_tree.delete(node)
+            for iid in self.model.delete(node):
+                if fav_tree.exists(iid):
+                    fav_tree.delete(iid)
+                self.pending.pop(iid, None)
+            if node == self.iid_Merlin_favorite:
+                self.iid_Merlin_favorite = None
+            elif node == self.iid_Merlin_discover:
+                self.iid_Merlin_discover = None
             self.delete(node)
         else:
-            node = self.selection()
+            node = self.selected()
             if (event and event.widget in [self.rootGUI, self]) or \
                 event is None:
                 if not node:
@@ -324,7 +363,7 @@ class MerlinMainTree(MerlinTree):
                 else:
                     node_type = 'fichier'
                 detail = ''
-                if node_type == 'menu' and self.get_children(node):
+                if node_type == 'menu' and self.model.children(node):
                     detail = " et tout ce qu'il contient"
                 question = f"Effacer le {node_type} '{self.item(node, 'text')[3:]}'{detail} ?"
                 answer = tk.messagebox.askyesno("Confirmation",question)
@@ -335,55 +374,28 @@ class MerlinMainTree(MerlinTree):
 
 
     def add_menu(self):
-        current_node = self.selection()
+        current_node = self.selected()
         tt = self.set(current_node,'type')
         if tt== '2' or tt == '6' :
             #current selection is a directory, insert a child
-            iid = self.insert(current_node, 0, text=' \u25AE Nouveau Menu', tags="directory")
+            self.materialize(current_node, recursive=False)
+            parent, index = current_node, 0
         else:
             #current selection is a file, insert at the same level
-            iid = self.insert(self.parent(current_node), self.index(current_node)+1, text=' \u25AE Nouveau Menu', tags="directory")
-        self.set(iid, 'type', '6')
-        self.set(iid, 'add_time', str(int(time())))
-        self.set(iid, 'title', 'Nouveau Menu')
-        self.set(iid, 'uuid', str(uuid.uuid4()))
+            parent, index = self.parent(current_node), self.index(current_node)+1
+        node = self.model.insert(parent, index, 6, 'Nouveau Menu', uuid=str(uuid.uuid4()), add_time=int(time()))
+        iid = self.insert_node(parent, index, node)
         self.focus(iid)
         self.selection_set(iid)
         self.update()
         self.rootGUI.title_entry.focus_set()
 
-    def find_common_prefix_and_suffix(self,basenames):
-        if len(basenames) < 2:
-            return None, None
-        common_prefix = None
-        common_suffix = None
-        for basename in basenames:
-            if common_prefix is None:
-                common_prefix = basename
-                common_suffix = basename[::-1]
-            else:
-                common_prefix = os.path.commonprefix([common_prefix, basename])
-                common_suffix = os.path.commonprefix([common_suffix, basename[::-1]])
-        return common_prefix, common_suffix[::-1]
-    def shorten_filename(self,filename, trim_prefix, trim_suffix):
-        if trim_prefix is None and trim_suffix is None:
-            filename = os.path.splitext(os.path.basename(filename))[0]
-        else:
-            if trim_prefix is not None and filename.startswith(trim_prefix):
-                filename = filename[len(trim_prefix):]
-            if trim_suffix is not None and filename.endswith(trim_suffix):
-                filename = filename[:-len(trim_suffix)]
-        fb = filename.encode('UTF-8')
-        if len(fb) > 60:
-            fb = fb[:60]
-        return fb.decode('UTF-8')
-
-
     def add_sound(self):
-        current_node = self.selection()
+        current_node = self.selected()
         tt = self.set(current_node,'type')
         if tt== '2' or tt == '6' :
             #current selection is a directory, insert a child
+            self.materialize(current_node, recursive=False)
             parent_node = current_node
             insert_index = 9999999
         else:
@@ -402,43 +414,62 @@ class MerlinMainTree(MerlinTree):
                 messagebox.showerror('Error', 'Cannot add sound file from the same directory as the playlist')
                 return
                 
-        common_prefix, common_suffix = self.find_common_prefix_and_suffix(filepaths)
+        common_prefix, common_suffix = find_common_prefix_and_suffix(filepaths)
 
+        jobs = []
+        new_items = []
         for filepath in filepaths:
-            display_name = self.shorten_filename(filepath, common_prefix, common_suffix)
+            display_name = shorten_filename(filepath, common_prefix, common_suffix)
 
             new_uuid = str(uuid.uuid4())
             new_basename = new_uuid+".mp3"
             new_filepath = os.path.join(playlist_dirname,new_basename)
+            jobs.append((filepath, new_filepath))
+            new_items.append((display_name, new_uuid))
 
-            must_convert = True
-            try:
-                audiofile = MP3(filepath)
-                if audiofile.info.bitrate == 128000 and audiofile.info.channels == 2 and audiofile.info.sample_rate == 44100:
-                    must_convert = False
-            except:
-                pass
-            
-            if must_convert:
-                AudioSegment.from_file(filepath).export(new_filepath, format="mp3", bitrate="128k", parameters=["-ac", "2", "-ar", "44100"])    
-                logging.warning("encoded %s to %s", filepath, new_filepath)
-            else:
-                shutil.copyfile(filepath, new_filepath)
-                logging.warning("copied %s to %s", filepath, new_filepath)
+        # files are transcoded in worker processes, rows are inserted as they are ready
+        pool = TranscodePool(jobs)
+        dialog = ProgressDialog(self.rootGUI, "Ajout des sons", len(jobs), pool.cancel)
+        self.poll_transcoding(pool, dialog, parent_node, insert_index, new_items, dict(), [])
 
-            
-            iid = self.insert(parent_node, insert_index, text=' \u266A ' + display_name, tags='sound')
-            self.set(iid, 'type', '4')
-            self.set(iid, 'soundpath', new_filepath)
-            self.set(iid, 'add_time', str(int(time())))
-            self.set(iid, 'uuid', new_uuid)
-        if len(filepaths)==1:
+    def poll_transcoding(self, pool, dialog, parent_node, insert_index, new_items, iids, errors):
+        for index, error in pool.poll():
+            filepath, new_filepath = pool.jobs[index]
+            if error is not None:
+                errors.append(filepath)
+                continue
+            display_name, new_uuid = new_items[index]
+            # keep the selection order, whatever the completion order
+            previous = [i for i in iids if i < index]
+            following = [i for i in iids if i > index]
+            if previous:
+                position = self.index(iids[max(previous)])+1
+            elif following:
+                position = self.index(iids[min(following)])
+            else:
+                position = insert_index
+            node = self.model.insert(parent_node, position, 4, display_name, uuid=new_uuid, 
+                                     soundpath=new_filepath, add_time=int(time()))
+            iids[index] = self.insert_node(parent_node, position, node)
+        
+        if not pool.done():
+            dialog.set_progress(len(pool.delivered))
+            self.after(100, self.poll_transcoding, pool, dialog, parent_node, insert_index, new_items, iids, errors)
+            return
+        
+        pool.shutdown()
+        dialog.destroy()
+        if len(pool.jobs)==1 and iids:
+            iid = iids[0]
             self.focus(iid)
             self.selection_set(iid)
         self.update()
+        if errors:
+            message = "Les fichiers suivants n'ont pas pu être convertis:\n" + "\n".join([f"- '{f}'" for f in errors])
+            tk.messagebox.showwarning("Erreur de conversion", message)
 
     def select_image(self):
-        current_node = self.selection()
+        current_node = self.selected()
         playlist_dirname = os.path.dirname(self.rootGUI.playlistpath)
         if not current_node:
             return
@@ -460,13 +491,14 @@ class MerlinMainTree(MerlinTree):
             self.rootGUI.thumbnails[uuid] = ImageTk.PhotoImage(icon_small)
         
         self.item(current_node, image=self.rootGUI.thumbnails[uuid])
+        self.model.set_imagepath(current_node, dest_filepath)
         self.set(current_node, 'imagepath', dest_filepath)
         self.update()
         
     
     
     def toggleFavorite(self, *args):
-        node = self.selection()
+        node = self.selected()
         if self.tag_has('favorite', node):
             self.removeFromFavorite(node)
         else:
@@ -474,6 +506,7 @@ class MerlinMainTree(MerlinTree):
         
     def addToFavorite(self, node, index='end'):
         if node and self.tag_has('sound', node) and not self.tag_has('favorite', node):
+            self.model.add_favorite(node, index)
             self.item(node, tags=('sound', 'favorite'))
             self.set(node, 'Favori', '♥')
             self.rootGUI.fav_tree.insert('', index, iid=node, \
@@ -486,8 +519,8 @@ class MerlinMainTree(MerlinTree):
             self.rootGUI.sync_buttons_fav()
         
     def removeFromFavorite(self, node):
-        node = self.selection()
         if node and self.tag_has('sound', node):
+            self.model.remove_favorite(node)
             self.item(node, tags=('sound'))
             self.set(node, 'Favori', '')
             self.rootGUI.fav_tree.delete(node)
@@ -518,15 +551,20 @@ class MerlinFavTree(MerlinTree):
                 self.delete(c)
         
         # add data
-        nb_children = len(self.get_children())
-        fav_list = sorted([(int(main_tree.set(node,'fav_order')), node) for node in main_tree.tag_has('favorite') if not self.exists(node)], reverse=True)
-        for order, fav in enumerate(fav_list):
-            node = fav[1]
-            self.insert('', order+nb_children, iid=node, text=main_tree.item(node, 'text'), \
-                        image=main_tree.item(node, 'image'))
+        # everything comes from the model, the main tree is not queried
+        thumbnails = self.rootGUI.thumbnails
+        for index, node in enumerate(main_tree.model.favorites):
+            if not self.exists(node.iid):
+                self.insert('', index, iid=node.iid, text=' \u266A ' + node.title, \
+                            image=thumbnails.get(node.uuid, ''))
         self.update()
     
     
+    def move_node(self, node, parent, index):
+        self.rootGUI.main_tree.model.move_favorite(node, index)
+        self.move(node, parent, index)
+    
+    
     def play_sound(self, event):
         if self.rootGUI.enable_audio:
             node = self.identify_row(event.y)
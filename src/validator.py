@@ -0,0 +1,180 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+
+import os.path
+import zipfile
+
+
+# sizes of the uuid and title fields of playlist.bin
+MAX_UUID_BYTES = 64
+MAX_TITLE_BYTES = 66
+
+# media expected by the Merlin
+IMAGE_SIZE = (128, 128)
+SOUND_BITRATE = 128000
+SOUND_CHANNELS = 2
+SOUND_SAMPLE_RATE = 44100
+# mutagen estimates the bitrate of CBR files from their length, a 128k file can read as 127997
+BITRATE_TOLERANCE = 1000
+
+
+def issue(level, check, item, message):
+    return {'level': level, 'check': check, 'id': item['id'] if item else None,
+            'title': item['title'] if item else '', 'message': message}
+
+
+def item_ref(item):
+    # what the issues need of an item, kept instead of the whole item
+    return {'id': item['id'], 'title': item['title']}
+
+
+def validate_items(items):
+    # consistency of playlist items, returns a list of issues
+    # the items are read once: they can come from a generator
+    issues = []
+    by_id = dict()
+    children = dict()
+    nb_roots = 0
+    for item in items:
+        if item['id'] in by_id:
+            issues.append(issue('error', 'duplicate_id', item, "identifiant en double"))
+            continue
+        # (ref, parent id, type, number of children)
+        by_id[item['id']] = (item_ref(item), item['parent_id'], item['type'], item['nb_children'])
+        children.setdefault(item['parent_id'], []).append(item['order'])
+        if item['type'] == 1:
+            nb_roots += 1
+        if len(item['uuid'].encode('UTF-8')) > MAX_UUID_BYTES:
+            issues.append(issue('error', 'uuid', item, f"nom de fichier de plus de {MAX_UUID_BYTES} octets"))
+        if len(item['title'].encode('UTF-8')) > MAX_TITLE_BYTES:
+            issues.append(issue('error', 'title', item, f"titre de plus de {MAX_TITLE_BYTES} octets"))
+        # media files, when they are plain files on disk
+        for key in ('imagepath', 'soundpath'):
+            path = item.get(key, '')
+            if path and path[-4:] != '.zip' and not os.path.exists(path):
+                issues.append(issue('error', 'missing_file', item, f"fichier non trouvé: {path}"))
+    if nb_roots != 1:
+        issues.append(issue('error', 'root', None, f"{nb_roots} racines au lieu d'une"))
+
+    for id, (ref, parent_id, item_type, nb_children) in by_id.items():
+        if item_type != 1 and parent_id not in by_id:
+            issues.append(issue('error', 'parent', ref, "parent inexistant"))
+        orders = children.get(id, [])
+        if nb_children != len(orders) and item_type%32 not in [10, 18]:
+            issues.append(issue('error', 'nb_children', ref, f"nb_children vaut {nb_children} pour {len(orders)} enfants"))
+        if sorted(orders) != list(range(len(orders))):
+            issues.append(issue('error', 'order', ref, "ordre des enfants incohérent"))
+    return issues
+
+
+def media_checks(item, card=False):
+    # (ref, kind, path, member) of the media of an item that are copied as they are to the card
+    # plain images of a session are resized and re-encoded on export, they are checked only for a card (card=True)
+    checks = []
+    if item['type'] == 1:
+        return checks
+    for key, kind, extension in (('imagepath', 'image', '.jpg'), ('soundpath', 'sound', '.mp3')):
+        path = item.get(key, '')
+        if not path:
+            continue
+        if path[-4:] == '.zip':
+            checks.append((item_ref(item), kind, path, item['uuid'] + extension))
+        elif os.path.exists(path) and (kind == 'sound' or card):
+            checks.append((item_ref(item), kind, path, None))
+    return checks
+
+
+def card_issues(item):
+    # on the card, the Merlin finds the media of an item by its uuid
+    issues = []
+    for key, extension in (('imagepath', '.jpg'), ('soundpath', '.mp3')):
+        path = item.get(key, '')
+        if path and path[-4:] != '.zip' and os.path.basename(path) != item['uuid'] + extension:
+            issues.append(issue('error', 'name', item, f"le fichier {os.path.basename(path)} ne correspond pas à {item['uuid'] + extension}"))
+    if item['type'] in [4, 36] and item.get('soundpath') and not item.get('imagepath'):
+        issues.append(issue('warning', 'name', item, "son sans image"))
+    return issues
+
+
+def media_issues(item, kind, media_info):
+    issues = []
+    if kind == 'image':
+        if (media_info['width'], media_info['height']) != IMAGE_SIZE:
+            issues.append(issue('error', 'image_size', item,
+                                f"image de {media_info['width']}x{media_info['height']} au lieu de {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}"))
+        if media_info['progressive']:
+            issues.append(issue('error', 'progressive', item, "image au format jpeg progressif"))
+    else:
+        if abs(media_info['bitrate'] - SOUND_BITRATE) > BITRATE_TOLERANCE \
+                or media_info['channels'] != SOUND_CHANNELS or media_info['sample_rate'] != SOUND_SAMPLE_RATE:
+            issues.append(issue('error', 'sound_format', item,
+                                f"son à {round(media_info['bitrate']/1000)}ko/s, {media_info['channels']} canaux, "
+                                f"{media_info['sample_rate']}Hz au lieu de 128ko/s stéréo 44100Hz"))
+    return issues
+
+
+def probe_media(checks, media_index=None, max_workers=8):
+    # format of the images and sounds, probed in parallel from their headers
+    # the results are kept in the media index, so that the next validations only read it
+    from media_index import MediaIndex
+    media_index = media_index or MediaIndex()
+    issues = []
+    archives = dict()
+    try:
+        entries = []
+        for item, kind, path, member in checks:
+            if member is not None and path not in archives:
+                try:
+                    archives[path] = zipfile.ZipFile(path, 'r')
+                except (IOError, zipfile.BadZipFile) as e:
+                    archives[path] = e
+            entries.append((path, member, kind, archives.get(path) if member is not None else None))
+        # archives that cannot be opened are reported once per item
+        probed = [i for i, entry in enumerate(entries) if not isinstance(entry[3], Exception)]
+        results = media_index.media_infos([entries[i] for i in probed], max_workers)
+        media_infos = dict(zip(probed, results))
+        for i, (item, kind, path, member) in enumerate(checks):
+            if i not in media_infos:
+                issues.append(issue('error', 'unreadable', item, f"archive illisible: {path}: {archives[path]}"))
+                continue
+            media_info = media_infos[i]
+            if isinstance(media_info, KeyError):
+                issues.append(issue('error', 'missing_file', item, f"fichier non trouvé dans l'archive {path}: {member}"))
+            elif isinstance(media_info, Exception):
+                issues.append(issue('error', 'unreadable', item, f"fichier illisible: {member or path}: {media_info}"))
+            else:
+                issues += media_issues(item, kind, media_info)
+    finally:
+        for zfile in archives.values():
+            if not isinstance(zfile, Exception):
+                zfile.close()
+    return issues
+
+
+def validate(items, media=True, media_index=None, card=False, max_workers=8):
+    # report of the validation of playlist items, as a json-serializable dict
+    # the items are read once and are not kept, so that a playlist can be checked as it is streamed
+    nb_items = 0
+    naming = []
+    checks = []
+    def read(items):
+        # the media are listed while the tree is checked
+        nonlocal nb_items
+        for item in items:
+            nb_items += 1
+            if media:
+                if card:
+                    naming.extend(card_issues(item))
+                checks.extend(media_checks(item, card))
+            yield item
+    issues = validate_items(read(items)) + naming
+    if media:
+        issues += probe_media(checks, media_index, max_workers)
+    return {'items': nb_items,
+            'errors': sum(i['level'] == 'error' for i in issues),
+            'warnings': sum(i['level'] == 'warning' for i in issues),
+            'issues': issues}
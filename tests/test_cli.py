@@ -0,0 +1,120 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The commands, run on a card folder, a session and an archive, and their exit codes.
+
+import os
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+from PIL import Image
+import cli
+from io_utils import write_merlin_playlist, load_merlin_playlist
+from playlist_model import PlaylistModel
+from session_journal import read_session
+
+
+def test_dump(tmp_path, capsys):
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'Menu A', uuid='a')
+    for s in range(2):
+        model.insert(menu.iid, 'end', 4, f'son {s}', uuid=f's{s}')
+    model.insert(menu.iid, 0, 6, 'sous menu', uuid='sm')
+    model.insert('', 'end', 4, 'son b', uuid='sb')
+    with open(tmp_path / 'playlist.bin', 'wb') as file:
+        write_merlin_playlist(file, model.iter_items())
+    with zipfile.ZipFile(tmp_path / 'merlin.zip', 'w') as zfile:
+        zfile.write(tmp_path / 'playlist.bin', 'playlist.bin')
+
+    assert cli.main(['dump', str(tmp_path)]) == 0
+    dump = capsys.readouterr().out
+    assert dump.splitlines() == ['+ Root []', '  + Menu A [a]', '    + sous menu [sm]',
+                                 '    - son 0 [s0]', '    - son 1 [s1]', '  - son b [sb]']
+    assert cli.main(['dump', str(tmp_path / 'merlin.zip')]) == 0
+    assert capsys.readouterr().out == dump
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # media index and transcoding cache of the commands
+    monkeypatch.setenv('MERLINATOR_CACHE_DIR', str(tmp_path / 'cache'))
+
+
+@pytest.fixture(scope='module')
+def sound(tmp_path_factory):
+    # a sound in the Merlin format when ffmpeg is there, else bytes that only look like one
+    path = tmp_path_factory.mktemp('sound') / 'son.mp3'
+    if shutil.which('ffmpeg'):
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=1', '-ac', '2',
+                        '-ar', '44100', '-b:a', '128k', str(path)], check=True)
+    else:
+        path.write_bytes(b'ID3' + bytes(1000))
+    return path
+
+
+@pytest.fixture
+def card(tmp_path, sound):
+    # a card folder with two menus of two sounds
+    card = tmp_path / 'card'
+    card.mkdir()
+    model = PlaylistModel()
+    for m in range(2):
+        menu = model.insert('', 'end', 6, f'Menu {m}', uuid=f'm{m}')
+        Image.new('RGB', (128, 128)).save(card / f'm{m}.jpg')
+        for s in range(2):
+            model.insert(menu.iid, 'end', 4, f'son {m}.{s}', uuid=f's{m}{s}')
+            Image.new('RGB', (128, 128)).save(card / f's{m}{s}.jpg')
+            shutil.copyfile(sound, card / f's{m}{s}.mp3')
+    with open(card / 'playlist.bin', 'wb') as file:
+        write_merlin_playlist(file, model.iter_items())
+    return card
+
+
+def titles(items):
+    return sorted(item['title'] for item in items)
+
+
+def test_import_and_exports(tmp_path, card):
+    session = str(tmp_path / 'session.json')
+    assert cli.main(['import', str(card), session]) == 0
+    assert titles(read_session(session)) == titles(load_merlin_playlist(str(card / 'playlist.bin')))
+
+    assert cli.main(['export-bin', session, str(tmp_path / 'playlist.bin')]) == 0
+    assert titles(load_merlin_playlist(str(tmp_path / 'playlist.bin'))) == titles(read_session(session))
+
+    assert cli.main(['export-zip', session, str(tmp_path / 'merlin.zip')]) == 0
+    with zipfile.ZipFile(tmp_path / 'merlin.zip') as zfile:
+        assert len(zfile.namelist()) == 1 + 2 + 4*2
+
+    os.remove(card / 's01.mp3')
+    assert cli.main(['export-zip', session, str(tmp_path / 'incomplete.zip')]) == 1
+
+
+def test_sync(tmp_path, card):
+    session = str(tmp_path / 'session.json')
+    assert cli.main(['import', str(card), session]) == 0
+    copy = tmp_path / 'copy'
+    copy.mkdir()
+    assert cli.main(['sync', session, str(copy)]) == 0
+    assert sorted(os.listdir(copy)) == sorted(os.listdir(card))
+    # missing sound: the playlist of the card is not written
+    os.remove(card / 's01.mp3')
+    other = tmp_path / 'other'
+    other.mkdir()
+    assert cli.main(['sync', session, str(other)]) == 1
+    assert not (other / 'playlist.bin').exists()
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is needed to write a sound in the Merlin format")
+def test_validate(card, capsys):
+    assert cli.main(['validate', str(card)]) == 0
+    os.remove(card / 's01.mp3')
+    assert cli.main(['validate', str(card)]) == 1
+    assert cli.main(['validate', str(card / 'absent.bin')]) == 1
+    capsys.readouterr()
@@ -0,0 +1,56 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The playback streams of zip members.
+
+import os
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+from io_utils import info
+from playback_source import PlaybackSources
+
+
+DATA = bytes(range(256)) * 1000
+
+
+@pytest.fixture
+def sources(tmp_path):
+    sources = PlaybackSources(cache_dir=str(tmp_path / 'cache'))
+    yield sources
+    sources.close()
+
+
+@pytest.mark.parametrize('compress_type', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_member(tmp_path, sources, compress_type):
+    path = str(tmp_path / 'sons.zip')
+    with zipfile.ZipFile(path, 'w') as zfile:
+        zfile.writestr('a.mp3', DATA, compress_type=compress_type)
+    with sources.open(path, 'a.mp3') as stream:
+        stream.seek(1000)
+        assert stream.read(100) == DATA[1000:1100]
+        stream.seek(0)
+        assert stream.read() == DATA
+
+
+@pytest.mark.skipif(shutil.which('zip') is None, reason="zip is needed to write encrypted members")
+@pytest.mark.parametrize('level', ['-0', '-6'])
+def test_encrypted_member(tmp_path, sources, level):
+    # the archives of the Merlin are protected by its password: encrypted members,
+    # even stored ones, are decrypted with it into the spill cache
+    path = str(tmp_path / 'sons.zip')
+    subprocess.run(['zip', '-q', level, '-P', info.decode(), path, '-'], input=DATA, check=True)
+    with zipfile.ZipFile(path) as zfile:
+        assert zfile.getinfo('-').flag_bits & 0x1
+    with sources.open(path, '-') as stream:
+        stream.seek(1000)
+        assert stream.read(100) == DATA[1000:1100]
+        stream.seek(0)
+        assert stream.read() == DATA
+    assert len(os.listdir(tmp_path / 'cache' / 'playback')) == 1
@@ -0,0 +1,38 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The records of playlist.bin.
+
+import pytest
+
+from io_utils import RECORD_SIZE, encode_merlin_playlist, decode_merlin_playlist
+
+
+def make_item(title, uuid='son'):
+    return {'id': 1, 'parent_id': 0, 'order': 0, 'nb_children': 0, 'fav_order': 0, 'type': 4,
+            'limit_time': 0, 'add_time': 1650000000, 'uuid': uuid, 'title': title}
+
+
+def roundtrip(item):
+    data = encode_merlin_playlist([item])
+    assert len(data) == RECORD_SIZE
+    return decode_merlin_playlist(bytes(data))[0]
+
+
+def test_roundtrip():
+    item = make_item('Épisode 1')
+    assert roundtrip(item) == item
+
+
+def test_long_title_is_shortened():
+    assert roundtrip(make_item('x' * 70))['title'] == 'x' * 66
+    # 'é' takes two bytes, it is not cut in half
+    assert roundtrip(make_item('x' + 'é' * 40))['title'] == 'x' + 'é' * 32
+
+
+def test_long_uuid():
+    with pytest.raises(ValueError):
+        encode_merlin_playlist([make_item('titre', uuid='u' * 65)])
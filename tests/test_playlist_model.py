@@ -0,0 +1,120 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The edits of the playlist model, as made by the tree views on the selected node.
+
+from playlist_model import PlaylistModel
+from treeviews import MerlinTree, MerlinMainTree
+
+
+def make_model():
+    # a menu with three sounds, and a menu with one sound
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'menu A', uuid='a')
+    for s in range(3):
+        model.insert(menu.iid, 'end', 4, f'son A{s}', uuid=f'a{s}')
+    menu = model.insert('', 'end', 6, 'menu B', uuid='b')
+    model.insert(menu.iid, 'end', 4, 'son B0', uuid='b0')
+    return model
+
+
+def find(model, title):
+    return next(node.iid for node in model.walk() if node.title == title)
+
+
+def titles(model, iid=''):
+    return [node.title for node in model.children(iid)]
+
+
+class Selection:
+    # Treeview.selection() returns a tuple of iids
+    def __init__(self, *iids):
+        self.iids = iids
+
+    def selection(self):
+        return self.iids
+
+
+def test_selected():
+    assert MerlinTree.selected(Selection('n3')) == 'n3'
+    assert MerlinTree.selected(Selection()) == ''
+
+
+def test_move():
+    model = make_model()
+    menu = find(model, 'menu A')
+    node = find(model, 'son A1')
+    model.move(node, menu, model.index(node)-1)
+    assert titles(model, menu) == ['son A1', 'son A0', 'son A2']
+    model.move(node, menu, 'end')
+    assert titles(model, menu) == ['son A0', 'son A2', 'son A1']
+    model.move(node, model.parent(menu), 'end')
+    assert titles(model) == ['menu A', 'menu B', 'son A1']
+
+
+def test_rename_and_delete():
+    model = make_model()
+    model.set_title(find(model, 'son A1'), 'nouveau titre')
+    assert titles(model, find(model, 'menu A')) == ['son A0', 'nouveau titre', 'son A2']
+    removed = model.delete(find(model, 'menu B'))
+    assert len(removed) == 2 and titles(model) == ['menu A']
+    assert len(model) == 4
+
+
+def test_favorites():
+    model = make_model()
+    for title in ('son A0', 'son A1', 'son B0'):
+        model.add_favorite(find(model, title))
+    model.move_favorite(find(model, 'son A1'), 0)
+    assert [node.title for node in model.favorites] == ['son A1', 'son A0', 'son B0']
+    model.remove_favorite(find(model, 'son A0'))
+    assert not model.is_favorite(find(model, 'son A0'))
+    model.delete(find(model, 'menu B'))
+    assert [node.title for node in model.favorites] == ['son A1']
+    items = list(model.iter_items())
+    assert [(item['title'], item['fav_order']) for item in items if item['fav_order']] == [('son A1', 1)]
+
+
+class LazyTree:
+    # the Treeview calls made by MerlinMainTree.materialize, recorded
+    materialize = MerlinMainTree.materialize
+
+    def __init__(self, model, pending):
+        self.model = model
+        self.pending = {iid: 'placeholder ' + iid for iid in pending}
+        self.inserted = []
+        self.deleted = []
+
+    def exists(self, iid):
+        return True
+
+    def delete(self, iid):
+        self.deleted.append(iid)
+
+    def insert_nodes(self, parent, nodes):
+        self.inserted.append((parent, [node.title for node in nodes]))
+
+
+def test_materialize_before_adding():
+    # add_menu and add_sound fill a menu that has never been opened before inserting into it
+    model = make_model()
+    menu = find(model, 'menu A')
+    tree = LazyTree(model, [menu, find(model, 'menu B')])
+    tree.materialize(menu, recursive=False)
+    assert tree.inserted == [(menu, ['son A0', 'son A1', 'son A2'])]
+    assert tree.deleted == ['placeholder ' + menu] and menu not in tree.pending
+    model.insert(menu, 0, 6, 'Nouveau Menu')
+    tree.materialize(menu, recursive=False)
+    assert len(tree.inserted) == 1
+    assert titles(model, menu) == ['Nouveau Menu', 'son A0', 'son A1', 'son A2']
+
+
+def test_materialize_recursive():
+    model = make_model()
+    tree = LazyTree(model, [find(model, 'menu A'), find(model, 'menu B')])
+    tree.materialize()
+    assert not tree.pending
+    assert sorted(titles for parent, titles in tree.inserted) == [['son A0', 'son A1', 'son A2'], ['son B0']]
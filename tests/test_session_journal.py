@@ -0,0 +1,94 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The autosave of sessions through their journal.
+
+import main_gui
+from main_gui import MerlinGUI
+from playlist_model import PlaylistModel
+from session_journal import SessionJournal, read_session
+
+
+def make_model():
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'Menu', uuid='menu')
+    model.insert(menu.iid, 'end', 4, 'son', uuid='son')
+    return model
+
+
+class Tree:
+    def __init__(self, model):
+        self.model = model
+
+    def get_children(self, iid):
+        return [node.iid for node in self.model.children(iid)]
+
+
+class GUI:
+    # what MerlinGUI.saveas_session uses
+    close_journal = MerlinGUI.close_journal
+    saveas_session = MerlinGUI.saveas_session
+
+    def __init__(self, model):
+        self.main_tree = Tree(model)
+        self.journal = None
+        self.sessionpath = ''
+
+
+def titles(items):
+    return [item['title'] for item in items]
+
+
+def test_edits_after_save_as_twice(tmp_path, monkeypatch):
+    gui = GUI(make_model())
+    for name in ('first.json', 'second.json', 'third.mls'):
+        monkeypatch.setattr(main_gui.filedialog, 'asksaveasfilename', lambda **kw: str(tmp_path / name))
+        gui.saveas_session()
+        assert gui.main_tree.model.journal is gui.journal
+    model = gui.main_tree.model
+    model.set_title(model.children('')[0].iid, 'Menu renommé')
+    assert gui.journal.nb_records == 1
+    gui.close_journal()
+    assert 'Menu renommé' in titles(read_session(str(tmp_path / 'third.mls')))
+    assert 'Menu renommé' not in titles(read_session(str(tmp_path / 'second.json')))
+
+
+def test_close_keeps_the_journal_of_another_session(tmp_path):
+    model = make_model()
+    first = SessionJournal(str(tmp_path / 'first.json'))
+    first.attach(model)
+    first.compact()
+    second = SessionJournal(str(tmp_path / 'second.json'))
+    second.attach(model)
+    second.compact()
+    first.close()
+    assert model.journal is second
+    second.close()
+    assert model.journal is None
+
+
+def test_edits_after_a_record_that_does_not_apply(tmp_path):
+    path = str(tmp_path / 'session.json')
+    model = make_model()
+    journal = SessionJournal(path)
+    journal.attach(model)
+    journal.compact()
+    menu = model.children('')[0].iid
+    model.set_title(menu, 'Menu 1')
+    journal.append({'op': 'delete', 'path': [5, 0]})
+    model.set_title(menu, 'Menu 2')
+    journal.close()
+
+    # the records after the one that does not apply are dropped with it
+    journal = SessionJournal(path)
+    items = journal.load()
+    assert 'Menu 1' in titles(items)
+    assert journal.nb_records == 1
+    model = PlaylistModel.from_items(items)
+    journal.attach(model)
+    model.set_title(model.children('')[0].iid, 'Menu 3')
+    journal.close()
+    assert 'Menu 3' in titles(read_session(path))
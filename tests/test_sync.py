@@ -0,0 +1,120 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The synchronization of a session with a card folder.
+
+import os
+
+import pytest
+
+from PIL import Image
+import io_utils
+from io_utils import SourceArchives, sync_media_file, sync_merlin_to_directory, load_merlin_playlist
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    # the images rendered by the synchronization
+    rendered = []
+    render_image = io_utils.render_image
+    def counting_render(imagepath):
+        rendered.append(imagepath)
+        return render_image(imagepath)
+    monkeypatch.setattr(io_utils, 'render_image', counting_render)
+    return rendered
+
+
+def sync(sourcepath, dirpath, check_hash=False):
+    with SourceArchives() as sources:
+        return sync_media_file(sources, 'u1.jpg', sourcepath, str(dirpath), check_hash)
+
+
+def test_unchanged_image_is_not_rendered(tmp_path, renders):
+    source = str(tmp_path / 'image.jpg')
+    card = tmp_path / 'card'
+    card.mkdir()
+    Image.new('RGB', (300, 200), 'red').save(source)
+    assert sync(source, card) == 'copied'
+    assert sync(source, card) == 'skipped'
+    assert len(renders) == 1
+    with Image.open(card / 'u1.jpg') as image:
+        assert image.size == (128, 128)
+
+    # a changed source is rendered again
+    Image.new('RGB', (300, 200), 'blue').save(source)
+    os.utime(source, (os.stat(source).st_mtime + 10,) * 2)
+    assert sync(source, card) == 'copied'
+    assert len(renders) == 2
+    with Image.open(card / 'u1.jpg') as image:
+        assert image.getpixel((64, 64))[2] > 200
+
+
+def test_check_hash_compares_the_rendered_image(tmp_path, renders):
+    source = str(tmp_path / 'image.jpg')
+    card = tmp_path / 'card'
+    card.mkdir()
+    Image.new('RGB', (300, 200), 'red').save(source)
+    assert sync(source, card) == 'copied'
+    # same content with another modification time: checked, and the time is updated
+    os.utime(source, (os.stat(source).st_mtime + 10,) * 2)
+    assert sync(source, card, check_hash=True) == 'skipped'
+    assert abs(os.stat(card / 'u1.jpg').st_mtime - os.stat(source).st_mtime) <= 2
+    assert sync(source, card) == 'skipped'
+    assert len(renders) == 2
+
+
+def make_items(tmp_path, nb_sounds):
+    # a root and nb_sounds sounds, whose files are in tmp_path/sources
+    sources = tmp_path / 'sources'
+    sources.mkdir()
+    items = [{'id': 1, 'parent_id': 0, 'order': 0, 'nb_children': nb_sounds, 'fav_order': 0, 'type': 1,
+              'limit_time': 0, 'add_time': 0, 'uuid': '', 'title': 'Root', 'imagepath': '', 'soundpath': ''}]
+    for s in range(nb_sounds):
+        path = sources / f's{s}.mp3'
+        path.write_bytes(b'ID3' + bytes([s]) * 100)
+        items.append({'id': s+2, 'parent_id': 1, 'order': s, 'nb_children': 0, 'fav_order': 0, 'type': 4,
+                      'limit_time': 0, 'add_time': 0, 'uuid': f's{s}', 'title': f'son {s}',
+                      'imagepath': '', 'soundpath': str(path)})
+    return items
+
+
+def test_sync_card(tmp_path):
+    items = make_items(tmp_path, 3)
+    card = tmp_path / 'card'
+    card.mkdir()
+    report = sync_merlin_to_directory(items, str(card))
+    assert sorted(report['copied']) == ['s0.mp3', 's1.mp3', 's2.mp3'] and report['playlist_written']
+    assert (card / 's1.mp3').read_bytes() == (tmp_path / 'sources' / 's1.mp3').read_bytes()
+    assert len(load_merlin_playlist(str(card / 'playlist.bin'))) == 4
+
+
+def test_failures_do_not_stop_the_sync(tmp_path):
+    items = make_items(tmp_path, 3)
+    card = tmp_path / 'card'
+    card.mkdir()
+    os.remove(items[1]['soundpath'])
+    # a source that cannot be read
+    os.remove(items[2]['soundpath'])
+    os.mkdir(items[2]['soundpath'])
+    report = sync_merlin_to_directory(items, str(card))
+    assert report['copied'] == ['s2.mp3']
+    assert report['files_not_found'] == ['s0.mp3']
+    assert [filename for filename, error in report['failed']] == ['s1.mp3']
+    # the card would refer to missing files
+    assert not report['playlist_written'] and not (card / 'playlist.bin').exists()
+
+
+def test_orphans_are_only_deleted_from_a_card(tmp_path):
+    items = make_items(tmp_path, 1)
+    folder = tmp_path / 'folder'
+    folder.mkdir()
+    (folder / 'vacances.jpg').write_bytes(b'photo')
+    report = sync_merlin_to_directory(items, str(folder), delete_orphans=True)
+    assert report['orphans'] == ['vacances.jpg'] and report['deleted'] == []
+    assert (folder / 'vacances.jpg').exists()
+    # the folder is now a card: its orphans are deleted
+    report = sync_merlin_to_directory(items, str(folder), delete_orphans=True)
+    assert report['deleted'] == ['vacances.jpg'] and not (folder / 'vacances.jpg').exists()
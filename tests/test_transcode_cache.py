@@ -0,0 +1,50 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The transcoding pool, and the cache of encoded sounds whose entries are hard linked to the exported sounds.
+
+import os
+import stat
+
+from audio_converter import TranscodeCache, TranscodePool
+
+
+def put(cache, tmp_path, key, size):
+    sound = tmp_path / (key + '.mp3')
+    sound.write_bytes(b'\xff' * size)
+    cache.put(key, str(sound))
+
+
+def test_get_keeps_the_modification_time(tmp_path):
+    cache = TranscodeCache(str(tmp_path / 'cache'))
+    put(cache, tmp_path, 'a', 100)
+    os.utime(cache.path('a'), (1000000000, 1000000000))
+    exported = tmp_path / 'export.mp3'
+    assert cache.get('a', str(exported))
+    assert exported.read_bytes() == b'\xff' * 100
+    # the exported sound may be the same inode: its modification time is the one compared by the sync
+    assert os.stat(exported).st_mtime == 1000000000
+    assert os.stat(cache.path('a')).st_atime > 1000000000
+    assert stat.S_IMODE(os.stat(exported).st_mode) & 0o044
+    assert not cache.get('b', str(tmp_path / 'missing.mp3'))
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = TranscodeCache(str(tmp_path / 'cache'), max_size=250)
+    put(cache, tmp_path, 'a', 100)
+    put(cache, tmp_path, 'b', 100)
+    # 'a' is older, but it has been used last
+    os.utime(cache.path('a'), (1000000002, 1000000000))
+    os.utime(cache.path('b'), (1000000001, 1000000001))
+    put(cache, tmp_path, 'c', 100)
+    assert os.path.exists(cache.path('a')) and os.path.exists(cache.path('c'))
+    assert not os.path.exists(cache.path('b'))
+
+
+def test_empty_pool():
+    pool = TranscodePool([])
+    assert pool.done() and pool.poll() == []
+    pool.shutdown()
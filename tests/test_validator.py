@@ -0,0 +1,111 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The validation of a playlist streamed from the model, as before an export, and of its media.
+
+import os
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+from PIL import Image
+from media_index import MediaIndex
+from playlist_model import PlaylistModel
+from validator import validate
+
+
+def make_model():
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'Menu', uuid='menu')
+    for s in range(3):
+        model.insert(menu.iid, 'end', 4, f'Épisode {s}', uuid=f'son{s}')
+    model.insert(menu.iid, 'end', 4, 'x' * 80, uuid='long')
+    return model
+
+
+def test_streamed_validation():
+    model = make_model()
+    streamed = validate(model.iter_items(), media=False)
+    assert streamed == validate(list(model.iter_items()), media=False)
+    assert streamed['items'] == 6
+    assert [(i['check'], i['title']) for i in streamed['issues']] == [('title', 'x' * 80)]
+
+
+def test_tree_errors():
+    items = list(make_model().iter_items())
+    items[2]['order'] = 5
+    items.append(dict(items[3]))
+    report = validate(iter(items), media=False)
+    assert sorted(i['check'] for i in report['issues']) == ['duplicate_id', 'order', 'title']
+    assert report['errors'] == 3 and report['items'] == 7
+
+
+def make_card(directory, sound):
+    # a menu with a sound and its image, as on a card
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'Menu', uuid='menu', imagepath=str(directory / 'menu.jpg'))
+    model.insert(menu.iid, 'end', 4, 'Épisode', uuid='son', imagepath=str(directory / 'son.jpg'), soundpath=str(directory / 'son.mp3'))
+    Image.new('RGB', (128, 128)).save(directory / 'menu.jpg')
+    Image.new('RGB', (128, 128)).save(directory / 'son.jpg')
+    shutil.copyfile(sound, directory / 'son.mp3')
+    return model
+
+
+def encode(path, channels):
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=1', '-ac', str(channels),
+                    '-ar', '44100', '-b:a', '128k', path], check=True)
+
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is needed to write the test sounds")
+
+
+@pytest.fixture(scope='module')
+def sounds(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('sounds')
+    encode(str(directory / 'stereo.mp3'), 2)
+    encode(str(directory / 'mono.mp3'), 1)
+    return directory
+
+
+def check(model, tmp_path):
+    report = validate(model.iter_items(), media_index=MediaIndex(str(tmp_path / 'media.sqlite')), card=True)
+    return sorted((i['level'], i['check'], i['title']) for i in report['issues'])
+
+
+@needs_ffmpeg
+def test_valid_card(tmp_path, sounds):
+    assert check(make_card(tmp_path, sounds / 'stereo.mp3'), tmp_path) == []
+
+
+@needs_ffmpeg
+def test_media_errors(tmp_path, sounds):
+    model = make_card(tmp_path, sounds / 'mono.mp3')
+    Image.new('RGB', (300, 200)).save(tmp_path / 'son.jpg')
+    Image.new('RGB', (128, 128)).save(tmp_path / 'menu.jpg', progressive=True)
+    assert check(model, tmp_path) == [('error', 'image_size', 'Épisode'), ('error', 'progressive', 'Menu'),
+                                      ('error', 'sound_format', 'Épisode')]
+
+
+@needs_ffmpeg
+def test_missing_files(tmp_path, sounds):
+    model = make_card(tmp_path, sounds / 'stereo.mp3')
+    os.remove(tmp_path / 'son.mp3')
+    assert check(model, tmp_path) == [('error', 'missing_file', 'Épisode')]
+
+
+@needs_ffmpeg
+def test_missing_members(tmp_path, sounds):
+    make_card(tmp_path, sounds / 'stereo.mp3')
+    zippath = str(tmp_path / 'merlin.zip')
+    model = PlaylistModel()
+    menu = model.insert('', 'end', 6, 'Menu', uuid='menu', imagepath=zippath)
+    model.insert(menu.iid, 'end', 4, 'Épisode', uuid='son', imagepath=zippath, soundpath=zippath)
+    with zipfile.ZipFile(zippath, 'w') as zfile:
+        zfile.write(tmp_path / 'menu.jpg', 'menu.jpg')
+        zfile.write(tmp_path / 'son.mp3', 'son.mp3')
+    assert check(model, tmp_path) == [('error', 'missing_file', 'Épisode')]
@@ -0,0 +1,57 @@
+# Copyright 2022 by Cyril Joder.
+# All rights reserved.
+# This file is part of merlinator, and is released under the
+# "MIT License Agreement". Please see the LICENSE file
+# that should have been included as part of this package.
+
+# The copy of members from a source archive to an exported zip.
+
+import io
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+import io_utils
+from io_utils import info, copy_from_archive, SourceArchives
+
+
+DATA = b'ID3' + bytes(range(256)) * 40
+
+
+def copy(archivepath, member):
+    stream = io.BytesIO()
+    with SourceArchives() as sources, zipfile.ZipFile(stream, 'w') as zfile:
+        assert copy_from_archive(sources, archivepath, member, zfile)
+    return zipfile.ZipFile(stream)
+
+
+@pytest.fixture
+def plain_zip(tmp_path):
+    path = str(tmp_path / 'plain.zip')
+    with zipfile.ZipFile(path, 'w') as zfile:
+        zfile.writestr('a.mp3', DATA, compress_type=zipfile.ZIP_DEFLATED)
+    return path
+
+
+@pytest.mark.parametrize('raw', [True, False])
+def test_copy_member(plain_zip, monkeypatch, raw):
+    monkeypatch.setattr(io_utils, 'RAW_COPY_SUPPORTED', raw)
+    with copy(plain_zip, 'a.mp3') as zfile:
+        assert zfile.testzip() is None
+        assert zfile.read('a.mp3') == DATA
+        # the raw copy keeps the compressed bytes, the streamed copy uses the settings of the export
+        assert (zfile.getinfo('a.mp3').compress_type == zipfile.ZIP_DEFLATED) == raw
+
+
+@pytest.mark.skipif(shutil.which('zip') is None, reason="zip is needed to write encrypted members")
+def test_copy_encrypted_member_with_data_descriptor(tmp_path):
+    # zip writes a member read from its standard input with a data descriptor,
+    # its password check byte is then taken from the time field
+    path = str(tmp_path / 'encrypted.zip')
+    subprocess.run(['zip', '-q', '-P', info.decode(), path, '-'], input=DATA, check=True)
+    with zipfile.ZipFile(path) as zin:
+        assert zin.getinfo('-').flag_bits & 0x09 == 0x09
+    with copy(path, '-') as zfile:
+        assert zfile.read('-', pwd=info) == DATA